@@ -1,32 +1,130 @@
+import logging
 import struct
 
+import net_log
 import net_messages
 
-
-class Generic:
-    def __init__(self, msg_type=None, data=None):
-        self._data = b""
-        self.msg_type = msg_type
-        
-        if data:
-            self.data = data
+log = logging.getLogger(__name__)
+
+
+def compile_schema(fields, schema):
+    # Generate encode()/decode() methods that pack/unpack every field of a message in one struct call
+    # fields is ((name, struct format), ...), text fields ("s" format) are converted to and from str
+    names = [name for name, _ in fields]
+    text_fields = [name for name, fmt in fields if fmt.endswith("s")]
+
+    encode_args = ", ".join(f"self.{name}.encode()" if name in text_fields else f"self.{name}" for name in names)
+    source = f"def encode(self):\n" \
+             f"    return pack({encode_args})\n" \
+             f"def decode(self):\n" \
+             f"    {', '.join(f'self.{name}' for name in names)}, = unpack_from(self._data)\n"
+    for name in text_fields:
+        # Views decode lazily, so a bad string must not raise here
+        source += f"    self.{name} = self.{name}.decode(errors='replace').partition('\\x00')[0]\n"
+
+    namespace = {"pack": schema.pack, "unpack_from": schema.unpack_from}
+    exec(source, namespace)
+    return namespace["encode"], namespace["decode"]
+
+
+class UAMessageType(type):
+    # Turns the payload declared by a UAMessage class into its __slots__, so packets don't carry a __dict__
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        if "__slots__" not in namespace:
+            namespace["__slots__"] = tuple(field for field, _ in namespace.get("payload", ()))
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class UAMessage(metaclass=UAMessageType):
+    # Base class of the USR_MSG_DATA packets: a 44 byte header followed by a message specific payload
+    # Subclasses only declare their payload, header and payload are compiled into one struct so a packet
+    # is packed with a single pack() and unpacked with a single unpack_from()
+    header = (("packet_flags", "B"), ("sequence_id", "I"), ("channel", "B"), ("packet_type", "B"),
+              ("packet_from", "Q"), ("packet_cast", "B"), ("packet_to", "Q"),
+              ("packet_payload_length", "I"), ("message_id", "I"), ("message_count", "I"), ("my_timestamp", "I"),
+              ("owner", "B"), ("p0", "B"), ("p1", "B"), ("p2", "B"))
+    payload = ()  # ((field name, struct format), ...), text fields use the "s" format and are str in Python
+    __slots__ = ("_data",) + tuple(field for field, _ in header)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if issubclass(cls, UAMessageView):
+            return
+
+        cls.fields = tuple(name for name, _ in cls.header + cls.payload)
+        cls.schema = struct.Struct("<" + "".join(fmt for _, fmt in cls.header + cls.payload))
+        encode, decode = compile_schema(cls.header + cls.payload, cls.schema)
+        # Keep encode()/decode() that a class writes itself
+        cls.encode = cls.__dict__.get("encode", encode)
+        cls.decode = cls.__dict__.get("decode", decode)
+        # Received packets are instances of this subclass, see from_data()
+        cls.View = type(cls)(cls.__name__, (UAMessageView, cls), {"__slots__": (), "__module__": cls.__module__,
+                                                                 "__qualname__": f"{cls.__qualname__}.View"})
+
+    @classmethod
+    def from_data(cls, data, **attributes):
+        # Wrap a received packet without decoding it, fields are decoded the first time one of them is read
+        if len(data) < cls.schema.size:
+            raise ValueError(f"{cls.__name__} packet is too short")
+
+        packet = cls.View.__new__(cls.View)
+        packet._data = data
+        for name, value in attributes.items():
+            setattr(packet, name, value)
+        return packet
 
     @property
     def data(self):
-        return self._data
+        return self.encode()
 
     @data.setter
     def data(self, value):
+        if len(value) < self.schema.size:
+            raise ValueError(f"{type(self).__name__} packet is too short")
+
         self._data = value
+        self.decode()
+
+
+class UAMessageView:
+    # Mixed into the View subclass of every UAMessage, a lazy view over a received buffer
+    # The View is a separate class so packets we build ourselves don't pay for the __getattr__ hook
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        # Only called for fields that are not set yet, so this is the first read of a field
+        if name in self.fields:
+            self.decode()
+            return getattr(self, name)
+
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    @property
+    def data(self):
+        # Received packets are passed on exactly as they came in
+        return self._data
+
+
+class Generic(UAMessage):
+    __slots__ = ("msg_type",)
+
+    def __init__(self, msg_type=None, data=None):
+        self.msg_type = msg_type
+        self._data = None
+
+        if data:
+            self.data = data
 
-        if len(value) > 36:
-            self.packet_flags, self.sequence_id, self.channel, self.packet_type = struct.unpack_from("<BIBB", value, 0)
-            self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-            self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-            self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
+    def encode(self):
+        return self._data or b""
 
 
 class Part:
+    # One part of a packet too big for a datagram, see net_reassembly for putting them back together
+    __slots__ = ("packet_flags", "sequence_id", "channel", "full_size", "offset", "part_data")
+
+    header = struct.Struct("<BIBII")  # flags, sequence_id, channel, full_size, offset
+
     def __init__(self, sequence_id=0, channel=0, full_size=0, offset=0, part_data=b'', data=None):
         # data=b"01 9d000000 01 a6050000 00000000 ..."
         self.packet_flags = net_messages.PKT_FLAG_PART
@@ -39,38 +137,32 @@ class Part:
             self.data = data
             # print(f"seq: {self.sequence_id}, ch: {self.channel}, size: {self.full_size}, "
             #      f"offset: {self.offset}, data_len: {len(self.part_data)}")
-    
-        self._reconstructed_packet = bytearray(full_size)
-        self._reconstructed_size = 0
-        self.add_part_data(self.offset, self.part_data)
-    
+
     @property
     def data(self):
-        ret = struct.pack("<BIBII", self.packet_flags, self.sequence_id, self.channel, self.full_size, self.offset)
+        ret = self.header.pack(self.packet_flags, self.sequence_id, self.channel, self.full_size, self.offset)
         ret += self.part_data
         return ret
-    
+
     @data.setter
     def data(self, value):
-        self.sequence_id, self.channel, self.full_size, self.offset = struct.unpack_from("<IBII", value, 1)
-        self.part_data = bytearray(value[14:])
-    
-    def add_part_data(self, offset, part_data):
-        start = offset
-        end = start + len(part_data)
-        self._reconstructed_packet[start:end] = part_data
-        self._reconstructed_size += len(part_data)
-        
-    def is_complete(self):
-        return self._reconstructed_size >= self.full_size
-
-    def reconstructed_packet(self):
-        # Set flags to PKT_FLAG_MASK_NORMAL and append reconstructed packet
-        header = struct.pack("<BIB", net_messages.PKT_FLAG_GARANT, self.sequence_id, self.channel)
-        return header + self._reconstructed_packet
+        _, self.sequence_id, self.channel, self.full_size, self.offset = self.header.unpack_from(value)
+        self.part_data = value[self.header.size:]  # A view of the received buffer when it is a memoryview
+
+    @classmethod
+    def split(cls, data, size):
+        # Serialized parts of a serialized non system packet, none longer than size bytes
+        # The parts carry everything after the flags, sequence_id and channel of the packet
+        sequence_id, channel = struct.unpack_from("<IB", data, 1)
+        payload = memoryview(data)[6:]
+        step = size - cls.header.size
+        return [cls(sequence_id, channel, len(payload), offset, payload[offset:offset + step]).data
+                for offset in range(0, len(payload), step)]
 
 
 class NetSysHandshake:
+    __slots__ = ("packet_flags", "packet_type", "network_name", "client_name")
+
     def __init__(self, client_name, data=None):
         # data=b"80 01 16 07 UA:SOURCE TEST NETWORKUnnamed"
         self.packet_flags = net_messages.PKT_FLAG_SYSTEM
@@ -93,11 +185,13 @@ class NetSysHandshake:
     def data(self, value):
         offset = 2
         network_name_length, client_name_length = struct.unpack_from("<BB", value, offset)
-        self.network_name = value[4: 4 + network_name_length].decode()
-        self.client_name = value[4 + network_name_length: 4 + network_name_length + client_name_length].decode()
+        self.network_name = bytes(value[4: 4 + network_name_length]).decode()
+        self.client_name = bytes(value[4 + network_name_length: 4 + network_name_length + client_name_length]).decode()
 
 
 class NetSysConnected:
+    __slots__ = ("packet_flags", "packet_type", "has_lobby", "user_id", "user_name")
+
     def __init__(self, client_name, client_id, data=None):
         # data=b"80 02 00 57a58b042c000000 0c Unnamed.8319"
         self.packet_flags = net_messages.PKT_FLAG_SYSTEM
@@ -123,10 +217,12 @@ class NetSysConnected:
         has_lobby, user_id, user_name_len = struct.unpack_from("<BQB", value, 2)
         self.has_lobby = has_lobby
         self.user_id = user_id
-        self.user_name = value[12:].decode()
+        self.user_name = bytes(value[12:]).decode()
 
 
 class NetSysDisconnected:
+    __slots__ = ("packet_flags", "packet_type")
+
     def __init__(self, data=None):
         # data=b"80 03"
         self.packet_flags = net_messages.PKT_FLAG_SYSTEM
@@ -145,6 +241,8 @@ class NetSysDisconnected:
 
 
 class NetSysPing:
+    __slots__ = ("packet_flags", "packet_type", "sequence_id")
+
     def __init__(self, sequence_id=0, data=None):
         # data=b"80 05 01000000"
         self.packet_flags = net_messages.PKT_FLAG_SYSTEM
@@ -164,6 +262,8 @@ class NetSysPing:
 
 
 class NetSysDelivered(NetSysPing):
+    __slots__ = ()
+
     def __init__(self, sequence_id=0, data=None):
         # data=b"80 07 01000000"
         super().__init__(sequence_id=sequence_id, data=data)
@@ -173,6 +273,8 @@ class NetSysDelivered(NetSysPing):
 
 
 class NetSysSessionJoin:
+    __slots__ = ("packet_flags", "packet_type", "leader", "game_id", "level_number", "server_name", "build_date")
+
     def __init__(self, game_id, level_number, hoster_name, data=None):
         # data=b"80 40 01 b820cc1129000000 20 93|Unnamed|JUL 09 1988  23:52:47"
         self.packet_flags = net_messages.PKT_FLAG_SYSTEM
@@ -202,12 +304,14 @@ class NetSysSessionJoin:
     @data.setter
     def data(self, value):
         self.leader, self.game_id = struct.unpack_from("<BQ", value, 2)
-        id_server_name_build_date = value[12:].decode()
+        id_server_name_build_date = bytes(value[12:]).decode()
         level_id, self.server_name, self.build_date = id_server_name_build_date.split("|")
         self.level_number = int(level_id)
 
 
 class NetSysSessionClose:
+    __slots__ = ("packet_flags", "packet_type", "close_time")
+
     def __init__(self, data=None):
         # data=b"80 46 00000000"
         self.packet_flags = net_messages.PKT_FLAG_SYSTEM
@@ -227,6 +331,8 @@ class NetSysSessionClose:
 
 
 class NetSysSessionLead:
+    __slots__ = ("packet_flags", "packet_type", "is_leader")
+
     def __init__(self, data=None):
         # data=b"80 42 01"
         self.packet_flags = net_messages.PKT_FLAG_SYSTEM
@@ -246,6 +352,8 @@ class NetSysSessionLead:
 
 
 class NetUsrSessionList:
+    __slots__ = ("packet_flags", "sequence_id", "channel", "packet_type", "users")
+
     def __init__(self, users, sequence_id=1, data=None):
         # data=b"00 01000000 00 42 02000000 691ecc1129000000 07 Unnamed 57a58b042c000000 0c Unnamed.1883"
         self.packet_flags = net_messages.PKT_FLAG_NONE
@@ -278,12 +386,14 @@ class NetUsrSessionList:
         for i in range(num_users):
             user_id, user_len = struct.unpack_from("<QB", value, offset)
             offset += 9
-            user_name = value[offset:offset + user_len].decode()
+            user_name = bytes(value[offset:offset + user_len]).decode()
             offset += user_len
             self.users[user_name] = user_id
 
 
 class NetUsrDisconnect:
+    __slots__ = ("packet_flags", "sequence_id", "channel", "packet_type", "player_id", "cast")
+
     def __init__(self, player_id, sequence_id=0, data=None):
         # data=b"00 0c000000 00 41 a08e5ddd0a030000 01"
         self.packet_flags = net_messages.PKT_FLAG_NONE
@@ -310,6 +420,8 @@ class NetUsrDisconnect:
 
 
 class NetUsrJoin:
+    __slots__ = ("packet_flags", "sequence_id", "channel", "packet_type", "user_id", "user_name")
+
     def __init__(self, client_name, client_id, sequence_id=0, data=None):
         # data=b"00 04000000 00 40 48b80105da4a0200 08 556e6e616d656433"
         #                                              U n n a m e d 3
@@ -340,12 +452,18 @@ class NetUsrJoin:
         self.sequence_id = sequence_id
         self.channel = channel
         self.user_id = user_id
-        self.user_name = value[16:].decode()
+        self.user_name = bytes(value[16:]).decode()
 
 
-class UAMessageWelcome:
+class UAMessageWelcome(UAMessage):
+    payload = (("faction", "H"), ("ready", "B"), ("cd", "B"))
+
     def __init__(self, to_id, from_id, sequence_id=2, faction=0, data=None):
         # data = b"02 02000000 01 10 691ecc1129000000 00 57a58b042c000000 14000000 fe030000 00000000 3a59bba2 00 0f 00 00 0100 01 01"
+        if data:
+            self.data = data
+            return
+
         self.packet_flags = net_messages.PKT_FLAG_GARANT
         self.sequence_id = sequence_id
         self.channel = 1
@@ -366,8 +484,6 @@ class UAMessageWelcome:
         self.faction = faction
         self.ready = 0
         self.cd = 1
-        if data:
-            self.data = data
 
     def __repr__(self):
         return f'<UAMessageWelcome(packet_from="{self.packet_from}", packet_cast="{self.packet_cast}", ' \
@@ -376,28 +492,16 @@ class UAMessageWelcome:
                f'p1="{self.p1}", p2="{self.p2}", faction="{self.faction}", ' \
                f'ready="{self.ready}", cd="{self.cd}")>'
 
-    @property
-    def data(self):
-        ret = struct.pack("<BIBB", self.packet_flags, self.sequence_id, self.channel, self.packet_type)
-        ret += struct.pack("<QBQ", self.packet_from, self.packet_cast, self.packet_to)
-        ret += struct.pack("<IIII", self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp)
-        ret += struct.pack("<BBBB", self.owner, self.p0, self.p1, self.p2)
-        ret += struct.pack("<HBB", self.faction, self.ready, self.cd)
-        return ret
-
-    @data.setter
-    def data(self, value):
-        self.packet_flags, self.sequence_id, self.channel = struct.unpack_from("<BIBx", value, 0)
-        self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-        self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-        self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
-        self.faction, self.ready, self.cd = struct.unpack_from("<HBB", value, 44)
 
+class UAMessageReady(UAMessage):
+    payload = (("ready", "B"), ("rp0", "B"), ("rp1", "B"), ("rp2", "B"))
 
-class UAMessageReady:
     def __init__(self, to_id, from_id, sequence_id=3, data=None):
         # data=b'02 16000000 01 10 bbbbfd37c8a3aaaa 01 c9ec98ee6be20000 14000000 ff030000 20420200 01000000 00 00 00 00 00 00 00 00'
         # data=b'02 15000000 01 10 bbbbfd37c8a3aaaa 01 c9ec98ee6be20000 14000000 ff030000 20420200 00000000 00 00 00 00 01 00 00 00'
+        if data:
+            self.data = data
+            return
 
         self.packet_flags = net_messages.PKT_FLAG_GARANT
         self.sequence_id = sequence_id
@@ -421,8 +525,6 @@ class UAMessageReady:
         self.rp0 = 0
         self.rp1 = 0
         self.rp2 = 0
-        if data:
-            self.data = data
 
     def __repr__(self):
         return f'<UAMessageReady(packet_from="{self.packet_from}", packet_cast="{self.packet_cast}", ' \
@@ -431,27 +533,16 @@ class UAMessageReady:
                f'p1="{self.p1}", p2="{self.p2}", ready="{self.ready}", ' \
                f'rp0="{self.rp0}", rp1="{self.rp1}", rp2="{self.rp2}")>'
 
-    @property
-    def data(self):
-        ret = struct.pack("<BIBB", self.packet_flags, self.sequence_id, self.channel, self.packet_type)
-        ret += struct.pack("<QBQ", self.packet_from, self.packet_cast, self.packet_to)
-        ret += struct.pack("<IIII", self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp)
-        ret += struct.pack("<BBBB", self.owner, self.p0, self.p1, self.p2)
-        ret += struct.pack("<BBBB", self.ready, self.rp0, self.rp1, self.rp2)
-        return ret
-
-    @data.setter
-    def data(self, value):
-        self.packet_flags, self.sequence_id, self.channel = struct.unpack_from("<BIBx", value, 0)
-        self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-        self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-        self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
-        self.ready, self.rp0, self.rp1, self.rp2 = struct.unpack_from("<BBBB", value, 44)
 
+class UAMessageCRC(UAMessage):
+    payload = (("checksum", "I"),)
 
-class UAMessageCRC:
     def __init__(self, to_id, from_id, sequence_id=3, data=None):
         # data=b"02 02000000 01 10 691ecc1129000000 00 b820cc1129000000 14000000 0d040000 00000000 b0a187d5 00 55 00 00 2ab4c182"
+        if data:
+            self.data = data
+            return
+
         self.packet_flags = net_messages.PKT_FLAG_GARANT
         self.sequence_id = sequence_id
         self.channel = 1
@@ -470,8 +561,6 @@ class UAMessageCRC:
         self.p2 = 0
 
         self.checksum = struct.unpack("<I", b"\x2a\xb4\xc1\x82")[0]
-        if data:
-            self.data = data
 
     def __repr__(self):
         return f'<UAMessageCRC(packet_from="{self.packet_from}", packet_cast="{self.packet_cast}", ' \
@@ -479,27 +568,16 @@ class UAMessageCRC:
                f'my_timestamp="{self.my_timestamp}", owner="{self.owner}", p0="{self.p0}", ' \
                f'p1="{self.p1}", p2="{self.p2}", checksum="{self.checksum}")>'
 
-    @property
-    def data(self):
-        ret = struct.pack("<BIBB", self.packet_flags, self.sequence_id, self.channel, self.packet_type)
-        ret += struct.pack("<QBQ", self.packet_from, self.packet_cast, self.packet_to)
-        ret += struct.pack("<IIII", self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp)
-        ret += struct.pack("<BBBB", self.owner, self.p0, self.p1, self.p2)
-        ret += struct.pack("<I", self.checksum)
-        return ret
-
-    @data.setter
-    def data(self, value):
-        self.packet_flags, self.sequence_id, self.channel = struct.unpack_from("<BIBx", value, 0)
-        self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-        self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-        self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
-        self.checksum = struct.unpack_from("<I", value, 44)[0]
 
+class UAMessageCD(UAMessage):
+    payload = (("cd", "B"), ("ready", "B"), ("cd_p0", "B"), ("cd_p1", "B"))
 
-class UAMessageCD:
     def __init__(self, to_id, from_id, sequence_id=0, data=None):
         # data=b"02 02000000 01 10 691ecc1129000000 00 b820cc1129000000 14000000 12040000 00000000 a04b1000 00 61 00 00 01 ff 00 00"
+        if data:
+            self.data = data
+            return
+
         self.packet_flags = net_messages.PKT_FLAG_GARANT
         self.sequence_id = sequence_id
         self.channel = 1
@@ -521,8 +599,6 @@ class UAMessageCD:
         self.ready = 255
         self.cd_p0 = 1
         self.cd_p1 = 1
-        if data:
-            self.data = data
 
     def __repr__(self):
         return f'<UAMessageCD(user_id="{self.packet_from}", packet_cast="{self.packet_cast}", ' \
@@ -531,27 +607,16 @@ class UAMessageCD:
                f'p1="{self.p1}", p2="{self.p2}", ready="{self.ready}", cd="{self.cd}", ' \
                f'cd_p0="{self.cd_p0}", cd_p1="{self.cd_p1}")>'
 
-    @property
-    def data(self):
-        ret = struct.pack("<BIBB", self.packet_flags, self.sequence_id, self.channel, self.packet_type)
-        ret += struct.pack("<QBQ", self.packet_from, self.packet_cast, self.packet_to)
-        ret += struct.pack("<IIII", self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp)
-        ret += struct.pack("<BBBB", self.owner, self.p0, self.p1, self.p2)
-        ret += struct.pack("<BBBB", self.cd, self.ready, self.cd_p0, self.cd_p1)
-        return ret
 
-    @data.setter
-    def data(self, value):
-        self.packet_flags, self.sequence_id, self.channel = struct.unpack_from("<BIBx", value, 0)
-        self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-        self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-        self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
-        self.cd, self.ready, self.cd_p0, self.cd_p1 = struct.unpack_from("<BBBB", value, 44)
+class UAMessageFaction(UAMessage):
+    payload = (("old", "H"), ("new", "H"))
 
-
-class UAMessageFaction:
     def __init__(self, to_id, from_id, data=None):
         # data=b"02 02000000 01 10 691ecc1129000000 00 b820cc1129000000 14000000 fd030000 00000000 20754s48 00 7f 00 00 0000 0200"
+        if data:
+            self.data = data
+            return
+
         self.packet_flags = net_messages.PKT_FLAG_GARANT
         self.sequence_id = 0
         self.channel = 1
@@ -571,8 +636,6 @@ class UAMessageFaction:
 
         self.new = 1
         self.old = 1
-        if data:
-            self.data = data
 
     def __repr__(self):
         return f'<UAMessageFaction(user_id="{self.packet_from}", packet_cast="{self.packet_cast}", ' \
@@ -580,27 +643,16 @@ class UAMessageFaction:
                f'my_timestamp="{self.my_timestamp}", owner="{self.owner}", p0="{self.p0}", ' \
                f'p1="{self.p1}", p2="{self.p2}", new="{self.new}", old="{self.old}")>'
 
-    @property
-    def data(self):
-        ret = struct.pack("<BIBB", self.packet_flags, self.sequence_id, self.channel, self.packet_type)
-        ret += struct.pack("<QBQ", self.packet_from, self.packet_cast, self.packet_to)
-        ret += struct.pack("<IIII", self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp)
-        ret += struct.pack("<BBBB", self.owner, self.p0, self.p1, self.p2)
-        ret += struct.pack("<HH", self.old, self.new)
-        return ret
-
-    @data.setter
-    def data(self, value):
-        self.packet_flags, self.sequence_id, self.channel = struct.unpack_from("<BIBx", value, 0)
-        self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-        self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-        self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
-        self.old, self.new = struct.unpack_from("<HH", value, 44)
 
+class UAMessageLoadGame(UAMessage):
+    payload = (("level_number", "I"),)
 
-class UAMessageLoadGame:
     def __init__(self, to_id, from_id, level_number, sequence_id=0, my_timestamp=0, data=None):
         # data=b"02 06000000 01 10 691ecc1129000000 00 b820cc1129000000 14000000 e8030000 00000000 00640000 00 61 00 00 5d000000"
+        if data:
+            self.data = data
+            return
+
         self.packet_flags = net_messages.PKT_FLAG_GARANT
         self.sequence_id = sequence_id
         self.channel = 1
@@ -619,30 +671,17 @@ class UAMessageLoadGame:
         self.p2 = 0
 
         self.level_number = level_number
-        if data:
-            self.data = data
 
-    @property
-    def data(self):
-        ret = struct.pack("<BIBB", self.packet_flags, self.sequence_id, self.channel, self.packet_type)
-        ret += struct.pack("<QBQ", self.packet_from, self.packet_cast, self.packet_to)
-        ret += struct.pack("<IIII", self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp)
-        ret += struct.pack("<BBBB", self.owner, self.p0, self.p1, self.p2)
-        ret += struct.pack("<I", self.level_number)
-        return ret
-
-    @data.setter
-    def data(self, value):
-        self.packet_flags, self.sequence_id, self.channel = struct.unpack_from("<BIBx", value, 0)
-        self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-        self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-        self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
-        self.level_number = struct.unpack_from("<I", value, 44)[0]
 
+class UAMessageMessage(UAMessage):
+    payload = (("message", "64s"),)
 
-class UAMessageMessage:
     def __init__(self, to_id, from_id, sequence_id=0, message="", my_timestamp=0, data=None):
         # data=b'02 02000000 01 10 57a58b042c000000 01 b820cc1129000000 50000000 fa030000 00000000 02000000 00 00 00 00 64000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000000'
+        if data:
+            self.data = data
+            return
+
         self.packet_flags = net_messages.PKT_FLAG_GARANT
         self.sequence_id = sequence_id
         self.channel = 1
@@ -661,37 +700,20 @@ class UAMessageMessage:
         self.p2 = 0
 
         self.message = message
-        if data:
-            self.data = data
-
-    @property
-    def data(self):
-        msg = bytearray(64)
-        msg_len = min(len(self.message), 64)
-        msg[:msg_len] = self.message[:msg_len].encode()
-
-        ret = struct.pack("<BIBB", self.packet_flags, self.sequence_id, self.channel, self.packet_type)
-        ret += struct.pack("<QBQ", self.packet_from, self.packet_cast, self.packet_to)
-        ret += struct.pack("<IIII", self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp)
-        ret += struct.pack("<BBBB", self.owner, self.p0, self.p1, self.p2)
-        ret += msg
-        return ret
 
-    @data.setter
-    def data(self, value):
-        self.packet_flags, self.sequence_id, self.channel = struct.unpack_from("<BIBx", value, 0)
-        self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-        self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-        self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
-        self.message = value[44:].decode()
-        self.message = self.message[:self.message.index("\x00")]
 
+class UAMessageSyncGame(UAMessage):
+    payload = (("host_id", "I"), ("gun0", "I"), ("gun1", "I"), ("gun2", "I"), ("gun3", "I"),
+               ("gun4", "I"), ("gun5", "I"), ("gun6", "I"), ("gun7", "I"))
 
-class UAMessageSyncGame:
     def __init__(self, to_id, from_id, my_timestamp=0, data=None):
         # data=b"02 0c000000 01 10 CCCCCCCCCCCCCCCC 01 BBBBBBBBBBBBBBBB 34000000 f7030000 00000000 00000000 01 62 00 00
         #        00000101 04000101 03000101 02000101 01000101 ff0f0000 1b5392e8 6f7f0000 e009d1c9"
         #        host_id  gun0     gun1     gun2     gun3     gun4     gun5     gun6     gun7
+        if data:
+            self.data = data
+            return
+
         self.packet_flags = net_messages.PKT_FLAG_GARANT
         self.sequence_id = 0
         self.channel = 1
@@ -718,38 +740,24 @@ class UAMessageSyncGame:
         self.gun5 = struct.unpack("<I", b"\x1b\x53\x92\xe8")[0]
         self.gun6 = struct.unpack("<I", b"\x6f\x7f\x00\x00")[0]
         self.gun7 = struct.unpack("<I", b"\xe0\x09\xd1\xc9")[0]
-        if data:
-            self.data = data
 
     def __repr__(self):
         return f"<UAMessageSyncGame(host_id={self.host_id}, " \
                f"gun0={self.gun0}, gun1={self.gun1}, gun2={self.gun2}, gun3={self.gun3}, " \
                f"gun4={self.gun4}, gun5={self.gun5}, gun6={self.gun6}, gun7={self.gun7}"
 
-    @property
-    def data(self):
-        ret = struct.pack("<BIBB", self.packet_flags, self.sequence_id, self.channel, self.packet_type)
-        ret += struct.pack("<QBQ", self.packet_from, self.packet_cast, self.packet_to)
-        ret += struct.pack("<IIII", self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp)
-        ret += struct.pack("<BBBB", self.owner, self.p0, self.p1, self.p2)
-        ret += struct.pack("<IIIIIIIII", self.host_id, self.gun0, self.gun1, self.gun2, self.gun3, self.gun4,
-                           self.gun5, self.gun6, self.gun7)
-        return ret
-
-    @data.setter
-    def data(self, value):
-        self.packet_flags, self.sequence_id, self.channel = struct.unpack_from("<BIBx", value, 0)
-        self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-        self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-        self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
-        self.host_id, self.gun0, self.gun1, self.gun2, self.gun3, self.gun4, self.gun5, self.gun6, self.gun7 = struct.unpack_from("<IIIIIIIII", value, 44)
 
+class UAMessageViewer(UAMessage):
+    payload = (("host_id", "I"), ("launcher", "I"), ("class_id", "B"), ("view", "B"), ("vp0", "B"), ("vp1", "B"))
 
-class UAMessageViewer:
     def __init__(self, to_id, from_id, my_timestamp=0, data=None):
         # data=b"02 07000000 01 10 691ecc1129000000 01 b820cc1129000000
         #        1c000000 f6030000 00000000 0077450d 01 ce 3e 93 00000101 fd7f0000 03 01 da 15"
         #                                                        id       launcher
+        if data:
+            self.data = data
+            return
+
         self.packet_flags = net_messages.PKT_FLAG_GARANT
         self.sequence_id = 0
         self.channel = 1
@@ -773,32 +781,19 @@ class UAMessageViewer:
         self.view = 1
         self.vp0 = 0xda
         self.vp1 = 0x15
-        if data:
-            self.data = data
-
-    @property
-    def data(self):
-        ret = struct.pack("<BIBB", self.packet_flags, self.sequence_id, self.channel, self.packet_type)
-        ret += struct.pack("<QBQ", self.packet_from, self.packet_cast, self.packet_to)
-        ret += struct.pack("<IIII", self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp)
-        ret += struct.pack("<BBBB", self.owner, self.p0, self.p1, self.p2)
-        ret += struct.pack("<IIBBBB", self.host_id, self.launcher, self.class_id, self.view, self.vp0, self.vp1)
-        return ret
 
-    @data.setter
-    def data(self, value):
-        self.packet_flags, self.sequence_id, self.channel = struct.unpack_from("<BIBx", value, 0)
-        self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-        self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-        self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
-        self.host_id, self.launcher, self.class_id, self.view, self.vp0, self.vp1 = struct.unpack_from("<IIBBBB", value, 44)
 
+class UAMessageRequestPing(UAMessage):
+    payload = (("timestamp", "I"),)
 
-class UAMessageRequestPing:
     def __init__(self, to_id, from_id, sequence_id=0, timestamp=0, my_timestamp=0, data=None):
         # data=b"02 07000000 01 10 691ecc1129000000 01 b820cc1129000000
         #        14000000 f6030000 00000000 0077450d 01 55 00 00 00000101"
         #                                                        timestamp
+        if data:
+            self.data = data
+            return
+
         self.packet_flags = net_messages.PKT_FLAG_GARANT
         self.sequence_id = sequence_id
         self.channel = 1
@@ -817,249 +812,141 @@ class UAMessageRequestPing:
         self.p2 = 0
 
         self.timestamp = timestamp
-        if data:
-            self.data = data
-
-    @property
-    def data(self):
-        ret = struct.pack("<BIBB", self.packet_flags, self.sequence_id, self.channel, self.packet_type)
-        ret += struct.pack("<QBQ", self.packet_from, self.packet_cast, self.packet_to)
-        ret += struct.pack("<IIII", self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp)
-        ret += struct.pack("<BBBB", self.owner, self.p0, self.p1, self.p2)
-        ret += struct.pack("<I", self.timestamp)
-        return ret
-
-    @data.setter
-    def data(self, value):
-        self.packet_flags, self.sequence_id, self.channel = struct.unpack_from("<BIBx", value, 0)
-        self.packet_from, self.packet_cast, self.packet_to = struct.unpack_from("<QBQ", value, 7)
-        self.packet_payload_length, self.message_id, self.message_count, self.my_timestamp = struct.unpack_from("<IIII", value, 24)
-        self.owner, self.p0, self.p1, self.p2 = struct.unpack_from("<BBBB", value, 40)
-        self.timestamp = struct.unpack_from("<I", value, 44)[0]
 
 
 class UAMessagePong(UAMessageRequestPing):
     def __init__(self, to_id=0, from_id=0, timestamp=0, my_timestamp=0, data=None):
         super(UAMessagePong, self).__init__(to_id=to_id, from_id=from_id,
                                             timestamp=timestamp, my_timestamp=my_timestamp, data=data)
-        self.message_id = net_messages.UAMSG_PONG
+        if not data:
+            self.message_id = net_messages.UAMSG_PONG
+
+
+class Broadcast:
+    # A packet serialized once and sent to several players
+    # The copies only differ in the sequence number and, for UAMessage packets, the sender or target player,
+    # those are patched into the serialized packet for each recipient instead of building a packet per player
+    __slots__ = ("template",)
+
+    sequence_id = struct.Struct("<I")  # Offset 1 of every non system packet
+    player_id = struct.Struct("<Q")  # packet_from at offset 7 and packet_to at offset 16 of UAMessage packets
+
+    def __init__(self, packet):
+        self.template = bytearray(packet.data)
+
+    def data(self, sequence_id, packet_from=None, packet_to=None):
+        self.sequence_id.pack_into(self.template, 1, sequence_id)
+        if packet_from is not None:
+            self.player_id.pack_into(self.template, 7, packet_from)
+        if packet_to is not None:
+            self.player_id.pack_into(self.template, 16, packet_to)
+
+        # The template is patched again for the next recipient, the returned copy is safe to queue
+        return bytes(self.template)
 
 
 class DataToClassException(Exception):
     pass
 
 
+# Every message data_to_class() understands, keyed by (flags class, system/user message id, ua message id)
+# The flags class is PKT_FLAG_PART, PKT_FLAG_SYSTEM or PKT_FLAG_NONE (user message), unused ids are 0
+decoders = {}
+ua_message_id = struct.Struct("<I")  # Offset 28 of USR_MSG_DATA packets
+
+
+def register_decoder(decoder, flags_class, message=0, ua_message=0, msg_type=None, verbose=True):
+    # decoder is called with the raw packet data and returns the packet object
+    # New message classes can hook themselves into data_to_class() by registering here
+    decoders[(flags_class, message, ua_message)] = (msg_type or decoder.__name__, decoder, verbose)
+
+
 def data_to_class(data):
+    key = None
     try:
         # Every message has packet flags
         flags = data[0]
 
-        #
-        # Multipart messages
-        #
         if flags & net_messages.PKT_FLAG_PART:
-            print("PKT_FLAG_PART")
-            return Part(data=data)
-
-        #
-        # System messages
-        #
-        if flags & net_messages.PKT_FLAG_MASK_SYSTEM:
-            system_message = data[1]
-
-            if system_message == net_messages.SYS_MSG_HANDSHAKE:
-                print("SYS_MSG_HANDSHAKE\n")
-                return NetSysHandshake(client_name=None, data=data)
-
-            if system_message == net_messages.SYS_MSG_CONNECTED:
-                print("SYS_MSG_CONNECTED\n")
-                return NetSysConnected(client_id=None, client_name=None, data=data)
-
-            if system_message == net_messages.SYS_MSG_DISCONNECT:
-                print("SYS_MSG_DISCONNECT\n")
-                return NetSysDisconnected(data=data)
-
-            if system_message == net_messages.SYS_MSG_PING:
-                # print("SYS_MSG_PING\n")
-                return NetSysPing(data=data)
-
-            if system_message == net_messages.SYS_MSG_DELIVERED:
-                # print("SYS_MSG_DELIVERED\n")
-                return NetSysDelivered(data=data)
-
-            if system_message == net_messages.SYS_MSG_SES_JOIN:
-                print("SYS_MSG_SES_JOIN\n")
-                return NetSysSessionJoin(game_id=None, hoster_name=None, level_number=0, data=data)
-
-            if system_message == net_messages.SYS_MSG_SES_CLOSE:  # Host sends this message when it closes the server
-                print("SYS_MSG_SES_CLOSE\n")
-                return NetSysSessionClose(data=data)
-
-            raise ValueError("Unknown system message!\n")
-
-        #
-        # User messages
-        #
-        sequence_id = data[1:5]
-        channel = data[5]
-        user_message = data[6]
-
-        if user_message == net_messages.USR_MSG_SES_USERLIST:
-            print("USR_MSG_SES_USERLIST\n")
-            return NetUsrSessionList(users=None, data=data)
-
-        if user_message == net_messages.USR_MSG_DATA:
-            source = struct.unpack_from("<Q", data, 7)[0]
-            cast = struct.unpack_from("<B", data, 15)[0]
-            destination = struct.unpack_from("<Q", data, 16)[0]
-            data_size = struct.unpack_from("<I", data, 24)[0]
-            ua_message = struct.unpack_from("<I", data, 28)[0]
-
-            if ua_message == net_messages.UAMSG_LOAD:
-                print("UAMSG_LOAD\n")
-                return UAMessageLoadGame(to_id=None, level_number=None, from_id=None, data=data)
-
-            if ua_message == net_messages.UAMSG_NEWVHCL:
-                print("UAMSG_NEWVHCL\n")
-                return Generic(msg_type="UAMSG_NEWVHCL", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_DESTROYVHCL:
-                print("UAMSG_DESTROYVHCL\n")
-                return Generic(msg_type="UAMSG_DESTROYVHCL", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_NEWWEAPON:
-                print("UAMSG_NEWWEAPON\n")
-                return Generic(msg_type="UAMSG_NEWWEAPON", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_SETSTATE:
-                print("UAMSG_SETSTATE\n")
-                return Generic(msg_type="UAMSG_SETSTATE", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_VHCLDATA_I:
-                # send vehicle data updates such as location
-                # print("UAMSG_VHCLDATA_I\n")
-                return Generic(msg_type="UAMSG_VHCLDATA_I", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_DEAD:
-                print("UAMSG_DEAD\n")
-                return Generic(msg_type="UAMSG_DEAD", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_VHCLENERGY:
-                print("UAMSG_VHCLENERGY\n")
-                return Generic(msg_type="UAMSG_VHCLENERGY", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_SECTORENERGY:
-                # conquer sector
-                print("UAMSG_SECTORENERGY\n")
-                return Generic(msg_type="UAMSG_SECTORENERGY", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_STARTBUILD:
-                # conquer sector
-                print("UAMSG_STARTBUILD\n")
-                return Generic(msg_type="UAMSG_STARTBUILD", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_VIEWER:
-                print("UAMSG_VIEWER\n")
-                return UAMessageViewer(to_id=None, from_id=None, data=data)
-
-            if ua_message == net_messages.UAMSG_SYNCGM:
-                print("UAMSG_SYNCGM\n")
-                return UAMessageSyncGame(to_id=None, from_id=None, data=data)
-
-            if ua_message == net_messages.UAMSG_HOSTDIE:
-                print("UAMSG_HOSTDIE\n")
-                return Generic(msg_type="UAMSG_HOSTDIE", data=data)
-
-            if ua_message == net_messages.UAMSG_MESSAGE:  # When someone sends a message
-                print("UAMSG_MESSAGE\n")
-                return UAMessageMessage(to_id=None, from_id=None, data=data)
-
-            if ua_message == net_messages.UAMSG_FACTION:
-                print("UAMSG_FACTION\n")
-                return UAMessageFaction(to_id=None, from_id=None, data=data)
-
-            if ua_message == net_messages.UAMSG_UPGRADE:
-                print("UAMSG_UPGRADE\n")
-                return Generic(msg_type="UAMSG_UPGRADE", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_WELCOME:
-                print("UAMSG_WELCOME\n")
-                return UAMessageWelcome(to_id=None, from_id=None, data=data)
-
-            if ua_message == net_messages.UAMSG_READY:
-                print("UAMSG_READY\n")
-                return UAMessageReady(to_id=None, from_id=None, data=data)
-
-            if ua_message == net_messages.UAMSG_REQUPDATE:
-                print("UAMSG_REQUPDATE\n")
-                return Generic(msg_type="UAMSG_REQUPDATE", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_UPDATE:
-                print("UAMSG_UPDATE\n")
-                return Generic(msg_type="UAMSG_UPDATE", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_IMPULSE:
-                print("UAMSG_IMPULSE\n")
-                return Generic(msg_type="UAMSG_IMPULSE", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_LOGMSG:
-                print("UAMSG_LOGMSG\n")
-                return Generic(msg_type="UAMSG_LOGMSG", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_REORDER:
-                print("UAMSG_REORDER\n")
-                return Generic(msg_type="UAMSG_REORDER", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_STARTPLASMA:
-                print("UAMSG_STARTPLASMA\n")
-                return Generic(msg_type="UAMSG_STARTPLASMA", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_ENDPLASMA:
-                print("UAMSG_ENDPLASMA\n")
-                return Generic(msg_type="UAMSG_ENDPLASMA", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_STARTBEAM:
-                print("UAMSG_STARTBEAM\n")
-                return Generic(msg_type="UAMSG_STARTBEAM", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_ENDBEAM:
-                print("UAMSG_ENDBEAM\n")
-                return Generic(msg_type="UAMSG_ENDBEAM", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_EXIT:
-                print("UAMSG_EXIT\n")  # Ghorkovs have left the game
-                return Generic(msg_type="UAMSG_EXIT", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_CRC:
-                print("UAMSG_CRC\n")
-                return UAMessageCRC(to_id=None, from_id=None, data=data)
-
-            if ua_message == net_messages.UAMSG_REQPING:
-                print("UAMSG_REQPING\n")
-                return Generic(msg_type="UAMSG_REQPING", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_PONG:
-                print("UAMSG_PONG\n")
-                return Generic(msg_type="UAMSG_PONG", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_CD:
-                # print("UAMSG_CD\n")
-                return UAMessageCD(to_id=None, from_id=None, data=data)
-
-            if ua_message == net_messages.UAMSG_SCORE:
-                print("UAMSG_SCORE\n")
-                return Generic(msg_type="UAMSG_SCORE", data=data)  # TODO FIXME
-
-            if ua_message == net_messages.UAMSG_BUILDINGVHCL:
-                print("UAMSG_BUILDINGVHCL\n")
-                return Generic(msg_type="UAMSG_BUILDINGVHCL", data=data)  # TODO FIXME
-
-            print(f"seq:{sequence_id}, ch: {channel}, usr_msg: {user_message}\n"
-                  f"src: {source} cast: {cast}, dst: {destination}, data_size: {data_size}\n"
-                  f"ua_message: {ua_message}")
-            raise ValueError(f"Unknown UA message! {ua_message}\n")
+            key = (net_messages.PKT_FLAG_PART, 0, 0)
+        elif flags & net_messages.PKT_FLAG_MASK_SYSTEM:
+            key = (net_messages.PKT_FLAG_SYSTEM, data[1], 0)
+        elif data[6] == net_messages.USR_MSG_DATA:
+            key = (net_messages.PKT_FLAG_NONE, net_messages.USR_MSG_DATA, ua_message_id.unpack_from(data, 28)[0])
+        else:
+            key = (net_messages.PKT_FLAG_NONE, data[6], 0)
+
+        msg_type, decoder, verbose = decoders[key]
+    except (IndexError, KeyError, struct.error):
+        log.warning("Unknown message! %s %s", key, net_log.Hex(data))
+        raise DataToClassException()
+
+    if verbose and log.isEnabledFor(logging.DEBUG):
+        log.debug(msg_type, extra={"msg_type": msg_type})
 
-        print(f"seq:{sequence_id}, ch: {channel}, usr_msg: {user_message}")
-        raise ValueError(f"Unknown message! {data}\n")
+    try:
+        return decoder(data)
     except Exception:
         raise DataToClassException()
+
+
+#
+# Multipart messages
+#
+register_decoder(lambda data: Part(data=data), net_messages.PKT_FLAG_PART, msg_type="PKT_FLAG_PART")
+
+#
+# System messages
+#
+register_decoder(lambda data: NetSysHandshake(client_name=None, data=data),
+                 net_messages.PKT_FLAG_SYSTEM, net_messages.SYS_MSG_HANDSHAKE, msg_type="SYS_MSG_HANDSHAKE")
+register_decoder(lambda data: NetSysConnected(client_id=None, client_name=None, data=data),
+                 net_messages.PKT_FLAG_SYSTEM, net_messages.SYS_MSG_CONNECTED, msg_type="SYS_MSG_CONNECTED")
+register_decoder(lambda data: NetSysDisconnected(data=data),
+                 net_messages.PKT_FLAG_SYSTEM, net_messages.SYS_MSG_DISCONNECT, msg_type="SYS_MSG_DISCONNECT")
+register_decoder(lambda data: NetSysPing(data=data),
+                 net_messages.PKT_FLAG_SYSTEM, net_messages.SYS_MSG_PING, msg_type="SYS_MSG_PING", verbose=False)
+register_decoder(lambda data: NetSysDelivered(data=data),
+                 net_messages.PKT_FLAG_SYSTEM, net_messages.SYS_MSG_DELIVERED, msg_type="SYS_MSG_DELIVERED",
+                 verbose=False)
+register_decoder(lambda data: NetSysSessionJoin(game_id=None, hoster_name=None, level_number=0, data=data),
+                 net_messages.PKT_FLAG_SYSTEM, net_messages.SYS_MSG_SES_JOIN, msg_type="SYS_MSG_SES_JOIN")
+# Host sends this message when it closes the server
+register_decoder(lambda data: NetSysSessionClose(data=data),
+                 net_messages.PKT_FLAG_SYSTEM, net_messages.SYS_MSG_SES_CLOSE, msg_type="SYS_MSG_SES_CLOSE")
+
+#
+# User messages
+#
+register_decoder(lambda data: NetUsrSessionList(users=None, data=data),
+                 net_messages.PKT_FLAG_NONE, net_messages.USR_MSG_SES_USERLIST, msg_type="USR_MSG_SES_USERLIST")
+
+# USR_MSG_DATA packets are only wrapped here, their fields are decoded when read
+for ua_message, cls in ((net_messages.UAMSG_LOAD, UAMessageLoadGame),
+                        (net_messages.UAMSG_VIEWER, UAMessageViewer),
+                        (net_messages.UAMSG_SYNCGM, UAMessageSyncGame),
+                        (net_messages.UAMSG_MESSAGE, UAMessageMessage),  # When someone sends a message
+                        (net_messages.UAMSG_FACTION, UAMessageFaction),
+                        (net_messages.UAMSG_WELCOME, UAMessageWelcome),
+                        (net_messages.UAMSG_READY, UAMessageReady),
+                        (net_messages.UAMSG_CRC, UAMessageCRC),
+                        (net_messages.UAMSG_CD, UAMessageCD),
+                        (net_messages.UAMSG_REQPING, UAMessageRequestPing),
+                        (net_messages.UAMSG_PONG, UAMessagePong)):
+    register_decoder(cls.from_data,
+                     net_messages.PKT_FLAG_NONE, net_messages.USR_MSG_DATA, ua_message, msg_type=cls.__name__,
+                     verbose=ua_message != net_messages.UAMSG_CD)
+
+# TODO FIXME These are only relayed so far
+for msg_type in ("UAMSG_NEWVHCL", "UAMSG_DESTROYVHCL", "UAMSG_NEWWEAPON", "UAMSG_SETSTATE",
+                 "UAMSG_VHCLDATA_I",  # send vehicle data updates such as location
+                 "UAMSG_DEAD", "UAMSG_VHCLENERGY",
+                 "UAMSG_SECTORENERGY", "UAMSG_STARTBUILD",  # conquer sector
+                 "UAMSG_HOSTDIE", "UAMSG_UPGRADE", "UAMSG_REQUPDATE", "UAMSG_UPDATE", "UAMSG_IMPULSE",
+                 "UAMSG_LOGMSG", "UAMSG_REORDER", "UAMSG_STARTPLASMA", "UAMSG_ENDPLASMA", "UAMSG_STARTBEAM",
+                 "UAMSG_ENDBEAM",
+                 "UAMSG_EXIT",  # Ghorkovs have left the game
+                 "UAMSG_SCORE", "UAMSG_BUILDINGVHCL"):
+    register_decoder(lambda data, msg_type=msg_type: Generic.from_data(data, msg_type=msg_type),
+                     net_messages.PKT_FLAG_NONE, net_messages.USR_MSG_DATA, getattr(net_messages, msg_type),
+                     msg_type=msg_type, verbose=msg_type != "UAMSG_VHCLDATA_I")
@@ -0,0 +1,94 @@
+import array
+import logging
+import socket
+import struct
+
+log = logging.getLogger(__name__)
+
+# Upgrading a running server without a restart window: the new server process connects to the old one over a
+# Unix stream socket and gets the bound UDP socket (SCM_RIGHTS) and a net_snapshot of the games in return
+# Both processes hold the same socket, so the datagrams arriving while the new process starts serving wait in
+# its buffer and nothing is lost or sent to a closed port
+# The old process stops serving once the new one confirmed it took over and exits, the new one listens for the
+# next upgrade once the old one closed the connection
+handoff_timeout = 5  # Seconds the other side may take to answer before the handoff is given up
+handoff_size = struct.Struct("<I")  # Size of the snapshot following it, sent along with the socket
+TOOK_OVER = b"\1"
+
+
+def handoff_address(port):
+    # Linux abstract socket namespace like net_workers.worker_address(), one server per UDP port
+    return f"\0uads-handoff-{port}"
+
+
+def listen(port):
+    # The socket a new server process connects to, None when another process listens for this port already
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(handoff_address(port))
+    except OSError as e:
+        log.warning("Can't listen for server upgrades: %s", e)
+        listener.close()
+        return None
+    listener.listen(1)
+    listener.setblocking(False)
+    return listener
+
+
+def accept(listener):
+    # The connection of a new server process, None when it went away before we got to it
+    try:
+        connection, _ = listener.accept()
+    except OSError:
+        return None
+    connection.settimeout(handoff_timeout)
+    return connection
+
+
+def hand_over(connection, sock, snapshot):
+    # Send sock and the snapshot to the new server process on connection
+    # Returns whether it took over, this process must not touch sock anymore then
+    # The new process starts listening once we hung up, so close the listener before closing the connection
+    try:
+        fds = array.array("i", [sock.fileno()])
+        connection.sendmsg([handoff_size.pack(len(snapshot))], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        connection.sendall(snapshot)
+        if connection.recv(1) != TOOK_OVER:
+            log.warning("The new server process didn't take over")
+            return False
+    except OSError as e:
+        log.warning("Couldn't hand the server over: %s", e)
+        return False
+    return True
+
+
+def take_over(port):
+    # Connect to the server serving port and take its socket over, returns the socket's fd and the snapshot
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with connection:
+        connection.settimeout(handoff_timeout)
+        connection.connect(handoff_address(port))
+        fds = array.array("i")
+        data, ancillary, flags, address = connection.recvmsg(handoff_size.size,
+                                                             socket.CMSG_LEN(fds.itemsize))
+        for level, kind, fd_data in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(fd_data[:len(fd_data) - len(fd_data) % fds.itemsize])
+        if len(data) != handoff_size.size or not fds:
+            raise ConnectionError("The running server didn't hand over its socket")
+
+        size = handoff_size.unpack(data)[0]
+        snapshot = bytearray()
+        while len(snapshot) < size:
+            chunk = connection.recv(size - len(snapshot))
+            if not chunk:
+                raise ConnectionError("The running server hung up during the handoff")
+            snapshot += chunk
+
+        connection.sendall(TOOK_OVER)
+        # Wait for the old process to stop serving, it hangs up once it's done with the socket
+        try:
+            connection.recv(1)
+        except socket.timeout:
+            log.warning("The old server process is still running")
+    return fds[0], snapshot
@@ -0,0 +1,89 @@
+import atexit
+import binascii
+import logging
+import logging.handlers
+import queue
+import sys
+
+
+class RateLimitFilter(logging.Filter):
+    # Lets at most `rate` records per second through for each message type
+    # Records logged with extra={"msg_type": ...} are limited per message type, others per log statement
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.windows = {}  # type: dict[str, list]
+        self.pruned = 0.0  # When windows were last pruned
+
+    def filter(self, record):
+        if record.created - self.pruned >= 1:
+            self.prune(record.created)
+
+        key = getattr(record, "msg_type", record.msg)
+        window = self.windows.get(key)
+
+        # window is [start time, records let through, records dropped]
+        if window is None or record.created - window[0] >= 1:
+            self.windows[key] = [record.created, 1, 0]
+            if window and window[2]:
+                record.msg = f"{record.getMessage()} ({window[2]} similar messages suppressed)"
+                record.args = None
+            return True
+
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+
+        window[2] += 1
+        return False
+
+    def prune(self, now):
+        # Forget the windows that ended, except those that still have to report suppressed records
+        self.pruned = now
+        self.windows = {key: window for key, window in self.windows.items() if now - window[0] < 1 or window[2]}
+
+
+class Hex:
+    # Logs bytes as hex, only when the record is written: pass it as an argument, not formatted into the message
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return binascii.hexlify(self.data).decode()
+
+
+listener = None  # type: logging.handlers.QueueListener
+
+
+def setup_logging(level=logging.INFO, rate=10, stream=None, process_name=False):
+    # Records are put on a queue by the packet loop and written by a background thread,
+    # a slow or blocked stdout never stalls receiving packets
+    # Call it once per process, worker processes call it after they are forked
+    global listener
+    log_queue = queue.SimpleQueue()
+
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    if rate:
+        queue_handler.addFilter(RateLimitFilter(rate))
+
+    writer = logging.StreamHandler(stream or sys.stdout)
+    process = " %(processName)s" if process_name else ""
+    writer.setFormatter(logging.Formatter(f"%(asctime)s %(levelname)s{process} %(name)s: %(message)s"))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(log_queue, writer)
+    listener.start()
+    atexit.register(stop_logging)  # Writes out the records still queued when the server exits
+
+
+def stop_logging():
+    # Writes out the queued records and stops the writer thread, before the process exits or exec()s
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
@@ -0,0 +1,147 @@
+import logging
+import struct
+
+import net_messages
+
+log = logging.getLogger(__name__)
+
+# Limits on packets that arrive in parts (PKT_FLAG_PART), so a client can't make the server hold on to memory
+max_packet_size = 64 * 1024  # Bytes of one reassembled packet
+max_client_bytes = 256 * 1024  # Bytes of unfinished packets per client, the oldest ones are dropped first
+max_game_bytes = 1024 * 1024  # Bytes of unfinished packets per game, the oldest ones are dropped first
+part_timeout = 10  # Seconds an unfinished packet waits for its missing parts
+
+header = struct.Struct("<BIB")  # flags, sequence_id and channel of the reassembled packet
+
+
+class PartialPacket:
+    # A packet that arrived in parts, the parts are copied straight into the buffer of the whole packet
+    __slots__ = ("client", "buffer", "intervals", "received", "expires")
+
+    def __init__(self, client, sequence_id, channel, full_size, expires):
+        self.client = client
+        self.buffer = bytearray(header.size + full_size)
+        header.pack_into(self.buffer, 0, net_messages.PKT_FLAG_GARANT, sequence_id, channel)
+        self.intervals = []  # Sorted, non overlapping (start, end) byte ranges received so far
+        self.received = 0  # Bytes received, duplicate or overlapping parts are only counted once
+        self.expires = expires
+
+    @property
+    def full_size(self):
+        return len(self.buffer) - header.size
+
+    def add(self, offset, part_data):
+        start = offset
+        end = offset + len(part_data)
+        self.buffer[header.size + start:header.size + end] = part_data
+
+        # Merge the range into the intervals and count what it adds
+        merged = []
+        added = end - start
+        for interval_start, interval_end in self.intervals:
+            if interval_end < start or interval_start > end:
+                merged.append((interval_start, interval_end))
+                continue
+            added -= max(0, min(end, interval_end) - max(start, interval_start))
+            start = min(start, interval_start)
+            end = max(end, interval_end)
+        merged.append((start, end))
+        merged.sort()
+        self.intervals = merged
+        self.received += added
+
+    def is_complete(self):
+        return self.received == self.full_size
+
+
+class Reassembler:
+    # Puts the parts of the packets the players of one game send back together
+    # Unfinished packets are keyed by (client, sequence_id, channel), so the parts of different clients
+    # never mix, and are dropped when they expire or a client or the game goes over its memory limit
+    __slots__ = ("loop", "clock", "packets", "client_bytes", "bytes", "timer")
+
+    def __init__(self, loop, clock):
+        self.loop = loop  # Runs the expiry timer, an asyncio loop or a net_timers.TimerQueue
+        self.clock = clock  # type: net_timers.Clock
+        self.packets = {}  # type: dict[tuple, PartialPacket]  # Oldest first
+        self.client_bytes = {}  # type: dict[tuple, int]
+        self.bytes = 0
+        self.timer = None  # Due when the oldest unfinished packet expires, None while there are none
+
+    def add(self, client, part):
+        # Returns the whole packet once its last part arrived, None until then
+        self.expire()
+
+        if part.offset + len(part.part_data) > part.full_size:
+            log.info("Ignoring part that doesn't fit its packet from %s", client)
+            return None
+
+        key = (client, part.sequence_id, part.channel)
+        packet = self.packets.get(key)
+        if packet is None:
+            if not 0 < part.full_size <= max_packet_size:
+                log.info("Ignoring part of a %s byte packet from %s", part.full_size, client)
+                return None
+
+            self.make_room(client, part.full_size)
+            packet = PartialPacket(client, part.sequence_id, part.channel, part.full_size,
+                                   self.clock.now + part_timeout)
+            self.packets[key] = packet
+            self.client_bytes[client] = self.client_bytes.get(client, 0) + part.full_size
+            self.bytes += part.full_size
+            if self.timer is None:
+                self.timer = self.loop.call_later(part_timeout, self.timeout)
+        elif part.full_size != packet.full_size:
+            log.info("Ignoring part that doesn't fit its packet from %s", client)
+            return None
+
+        packet.add(part.offset, part.part_data)
+        if not packet.is_complete():
+            return None
+
+        self.remove(key)
+        return packet.buffer
+
+    def make_room(self, client, size):
+        # Drop the oldest unfinished packets of the client, then of the game, until size more bytes fit
+        for key in [key for key in self.packets if key[0] == client]:
+            if self.client_bytes.get(client, 0) + size <= max_client_bytes:
+                break
+            log.info("Dropping unfinished packet %s of %s, too many unfinished packets", key[1], client)
+            self.remove(key)
+
+        for key in list(self.packets):
+            if self.bytes + size <= max_game_bytes:
+                break
+            log.info("Dropping unfinished packet %s of %s, too many unfinished packets", key[1], key[0])
+            self.remove(key)
+
+    def expire(self):
+        # Packets are kept oldest first and all wait equally long, so the expired ones are at the front
+        now = self.clock.now
+        while self.packets:
+            key, packet = next(iter(self.packets.items()))
+            if packet.expires > now:
+                break
+            log.info("Dropping unfinished packet %s of %s, its parts stopped coming", key[1], key[0])
+            self.remove(key)
+
+    def timeout(self):
+        # Clients that stop sending parts don't call add() anymore, their packets expire on this timer
+        self.timer = None
+        self.expire()
+        if self.packets:
+            oldest = next(iter(self.packets.values()))
+            self.timer = self.loop.call_later(max(0, oldest.expires - self.clock.now), self.timeout)
+
+    def remove(self, key):
+        packet = self.packets.pop(key)
+        self.bytes -= packet.full_size
+        self.client_bytes[packet.client] -= packet.full_size
+        if not self.client_bytes[packet.client]:
+            del self.client_bytes[packet.client]
+
+    def forget(self, client):
+        # The client left the game, its unfinished packets will never be completed
+        for key in [key for key in self.packets if key[0] == client]:
+            self.remove(key)
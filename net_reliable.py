@@ -0,0 +1,325 @@
+import collections
+import logging
+
+import net_classes
+import net_messages
+
+log = logging.getLogger(__name__)
+
+# Retransmission timeout, computed from the measured round trip time like TCP does (RFC 6298)
+initial_rto = 1.0  # Seconds before the first retransmission until a round trip was measured
+min_rto = 0.2
+max_rto = 10.0  # Backoff stops doubling here, the kick timeout takes care of players that never answer
+max_retries = 8  # Retransmissions of one packet before giving up on it
+max_in_flight = 64  # Unacknowledged packets per client, later ones wait in the backlog
+max_backlog = 1024  # Packets waiting for the window per client, more are dropped
+loss_gain = 1 / 16  # Weight of each sent or received packet in the loss rates
+max_gap = 64  # Sequence ids skipped at once that count as lost, bigger jumps are a client starting over
+window_size = 128  # Sequence ids below the highest one received that are remembered for duplicate suppression
+pace_burst = 8  # Datagrams a client gets at once, more are spread out over its round trip time
+
+sequence_id = net_classes.Broadcast.sequence_id  # Offset 1 of every non system packet
+
+
+class Unacked:
+    # A guaranteed packet that was sent and not acknowledged yet
+    __slots__ = ("data", "sent_time", "deadline", "rto", "retries")
+
+    def __init__(self, data, sent_time, rto):
+        self.data = data
+        self.sent_time = sent_time
+        self.deadline = sent_time + rto
+        self.rto = rto
+        self.retries = 0
+
+
+class LinkEstimator:
+    # Round trip time, jitter and packet loss of the connection to one client
+    # Round trips are measured from pings and from guaranteed packets acknowledged on the first try, losses from
+    # pings and guaranteed packets that weren't acknowledged and from gaps in the sequence ids the client sends
+    __slots__ = ("srtt", "rttvar", "rto", "sent_loss", "received_loss", "last_sequence_id", "ping_sequence_id",
+                 "ping_time")
+
+    def __init__(self):
+        self.srtt = None  # Smoothed round trip time in seconds, None until the first one was measured
+        self.rttvar = 0.0  # Mean deviation of the round trip time in seconds, the jitter
+        self.rto = initial_rto  # Retransmission timeout in seconds
+        self.sent_loss = 0.0  # Share of our packets that didn't reach the client
+        self.received_loss = 0.0  # Share of the client's packets that didn't reach us
+        self.last_sequence_id = None  # Highest sequence_id received from the client
+        self.ping_sequence_id = None  # The NetSysPing waiting for its NetSysDelivered
+        self.ping_time = 0.0
+
+    def measure(self, rtt):
+        # Round trip time sample in seconds, RFC 6298
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, min_rto), max_rto)
+
+    def sent(self, lost):
+        # One of our packets was acknowledged or has to be sent again
+        self.sent_loss += loss_gain * (lost - self.sent_loss)
+
+    def received(self, received_sequence_id):
+        # The client numbers its packets, every sequence id skipped since the highest one is a lost packet
+        # Late and repeated packets don't count, the client sends lost guaranteed packets again with the same id
+        last_sequence_id = self.last_sequence_id
+        if last_sequence_id is not None and received_sequence_id <= last_sequence_id:
+            if last_sequence_id - received_sequence_id >= window_size:
+                # Too far back to be late: the client started counting over, or the highest id came from a stray
+                # packet far ahead of its counter. Count from here on, like SequenceWindow starts over
+                self.last_sequence_id = received_sequence_id
+            return
+
+        self.last_sequence_id = received_sequence_id
+        if last_sequence_id is not None:
+            gap = received_sequence_id - last_sequence_id - 1
+            if 0 < gap <= max_gap:
+                self.received_loss = 1 - (1 - self.received_loss) * (1 - loss_gain) ** gap
+        self.received_loss -= loss_gain * self.received_loss
+
+    def ping_sent(self, ping_sequence_id, now):
+        # A ping still unanswered when the next one goes out was lost
+        if self.ping_sequence_id is not None:
+            self.sent(lost=True)
+        self.ping_sequence_id = ping_sequence_id
+        self.ping_time = now
+
+    def delivered(self, delivered_sequence_id, now):
+        # Returns whether the NetSysDelivered answered our last ping
+        if delivered_sequence_id != self.ping_sequence_id:
+            return False
+
+        self.ping_sequence_id = None
+        self.measure(now - self.ping_time)
+        self.sent(lost=False)
+        return True
+
+    def pong(self, timestamp, now_millis):
+        # A UAMSG_PONG echoes the timestamp of our UAMSG_REQPING, both in clock milliseconds
+        rtt = (now_millis - timestamp) & 0xFFFFFFFF
+        if rtt < max_rto * 1000:
+            self.measure(rtt / 1000)
+
+    def pace_interval(self):
+        # Seconds between bursts of paced datagrams, about a window of max_in_flight datagrams per round trip
+        if self.srtt is None:
+            return 0.005
+        return min(max(self.srtt * pace_burst / max_in_flight, 0.001), 0.02)
+
+    def ping_millis(self):
+        # Smoothed round trip time and jitter in whole milliseconds, for showing to players
+        if self.srtt is None:
+            return None, None
+        return round(self.srtt * 1000), round(self.rttvar * 1000)
+
+
+class SequenceWindow:
+    # Remembers which of the last window_size sequence ids a client sent were received, so guaranteed packets
+    # the client sends again because our ack got lost are only handled once
+    # Bit n of seen is set when highest - n was received
+    __slots__ = ("highest", "seen")
+
+    def __init__(self):
+        self.highest = None
+        self.seen = 0
+
+    def duplicate(self, received_sequence_id):
+        # Returns whether the sequence id was received before and marks it as received
+        if self.highest is None or received_sequence_id > self.highest:
+            shift = received_sequence_id - self.highest if self.highest is not None else window_size
+            if shift < window_size:
+                self.seen = ((self.seen << shift) | 1) & ((1 << window_size) - 1)
+            else:
+                self.seen = 1
+            self.highest = received_sequence_id
+            return False
+
+        offset = self.highest - received_sequence_id
+        if offset >= window_size:
+            # Too far back for a repeat: the client started counting over, or highest came from a stray
+            # packet far ahead of its counter. Start the window over rather than drop everything it sends
+            self.highest = received_sequence_id
+            self.seen = 1
+            return False
+        bit = 1 << offset
+        if self.seen & bit:
+            return True
+        self.seen |= bit
+        return False
+
+
+class Pacer:
+    # Sends datagrams to one client, bursts of more than pace_burst datagrams (the parts of a big packet)
+    # are spread out so they don't overflow a router queue on the way and get lost all together
+    # Once datagrams are waiting everything else queues behind them, so the client gets them in order
+    # Queued datagrams outlive the receive burst, so they are copied: a relayed datagram is a view of a pooled
+    # receive buffer that is reused for the next burst, see uads.receive_packets()
+    __slots__ = ("socket", "addr", "loop", "link", "queue", "timer")
+
+    def __init__(self, sock, addr, loop, link):
+        self.socket = sock
+        self.addr = addr
+        self.loop = loop  # Runs the pacing timer, an asyncio loop or a net_timers.TimerQueue
+        self.link = link  # type: LinkEstimator
+        self.queue = None  # Datagrams waiting for their turn, a deque while pacing
+        self.timer = None
+
+    def send(self, data):
+        if self.queue is None:
+            self.socket.sendto(data, self.addr)
+        else:
+            self.queue.append(bytes(data))
+
+    def send_all(self, datagrams):
+        if self.queue is None and len(datagrams) <= pace_burst:
+            for data in datagrams:
+                self.socket.sendto(data, self.addr)
+            return
+
+        if self.queue is None:
+            self.queue = collections.deque()
+        self.queue.extend(bytes(data) for data in datagrams)  # No copy for datagrams that are bytes already
+        if self.timer is None:
+            self.drain()
+
+    def drain(self):
+        self.timer = None
+        for _ in range(pace_burst):
+            if not self.queue:
+                break
+            self.socket.sendto(self.queue.popleft(), self.addr)
+
+        if self.queue:
+            self.timer = self.loop.call_later(self.link.pace_interval(), self.drain)
+        else:
+            self.queue = None
+
+    def flush(self):
+        # Send everything waiting at once, the server is handing its clients over to another process
+        if self.queue:
+            for data in self.queue:
+                self.socket.sendto(data, self.addr)
+        self.stop()
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.queue = None
+
+
+class ReliableQueue:
+    # Retransmits the PKT_FLAG_GARANT packets the server sends to one client until the client acknowledges them
+    # with a NetSysDelivered carrying the same sequence_id
+    # Every guaranteed packet the client gets carries one of our sequence_ids, relayed ones included, see
+    # UAMPClient.relay_data(), so an ack never clears or times a packet it doesn't belong to
+    __slots__ = ("send", "loop", "clock", "link", "in_flight", "backlog", "timer")
+
+    def __init__(self, send, loop, clock, link):
+        self.send = send  # Sends serialized data to the client, see UAMPClient.send_data()
+        self.loop = loop  # Runs the retransmit timer, an asyncio loop or a net_timers.TimerQueue
+        self.clock = clock  # type: net_timers.Clock
+        self.link = link  # type: LinkEstimator  # Gets the round trips and losses, gives the timeout
+        self.in_flight = {}  # type: dict[int, Unacked]  # sequence_id -> packet, oldest first
+        self.backlog = None  # Guaranteed packets waiting for room in the window, a deque once the window filled up
+        self.timer = None  # The retransmit timer, due at the earliest deadline of the packets in flight
+
+    @staticmethod
+    def is_guaranteed(data):
+        return data[0] & (net_messages.PKT_FLAG_GARANT | net_messages.PKT_FLAG_SYSTEM) == net_messages.PKT_FLAG_GARANT
+
+    def send_guaranteed(self, data):
+        if len(self.in_flight) < max_in_flight:
+            self.transmit(data)
+        elif self.backlog is None:
+            self.backlog = collections.deque((data,))
+        elif len(self.backlog) < max_backlog:
+            self.backlog.append(data)
+        else:
+            log.warning("Dropping guaranteed packet %s, too many unacknowledged packets",
+                        sequence_id.unpack_from(data, 1)[0])
+
+    def transmit(self, data):
+        packet = Unacked(data, self.clock.now, self.link.rto)
+        self.in_flight[sequence_id.unpack_from(data, 1)[0]] = packet
+        self.send(data)
+        if self.timer is None:
+            self.timer = self.loop.call_later(packet.rto, self.retransmit)
+
+    def delivered(self, delivered_sequence_id):
+        packet = self.in_flight.pop(delivered_sequence_id, None)
+        if packet is None:
+            return  # Acknowledges a ping or a packet that was acknowledged already
+
+        # Karn's algorithm: the ack of a retransmitted packet could belong to any of its copies
+        if not packet.retries:
+            self.link.measure(self.clock.now - packet.sent_time)
+            self.link.sent(lost=False)
+
+        while self.backlog and len(self.in_flight) < max_in_flight:
+            self.transmit(self.backlog.popleft())
+
+        if not self.in_flight and self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def retransmit(self):
+        # The timer fires at the earliest deadline, every packet past its deadline is sent again with twice the
+        # timeout, then the timer is scheduled for the next deadline
+        now = self.clock.now
+        self.timer = None
+        for packet_sequence_id, packet in list(self.in_flight.items()):
+            if packet.deadline > now:
+                continue
+
+            if packet.retries == max_retries:
+                log.warning("Giving up on guaranteed packet %s after %s retries", packet_sequence_id, max_retries)
+                del self.in_flight[packet_sequence_id]
+                continue
+
+            packet.retries += 1
+            self.link.sent(lost=True)
+            packet.rto = min(packet.rto * 2, max_rto)
+            packet.deadline = now + packet.rto
+            self.send(packet.data)
+
+        while self.backlog and len(self.in_flight) < max_in_flight:
+            self.transmit(self.backlog.popleft())
+
+        if self.timer is not None:
+            self.timer.cancel()  # Scheduled by transmit(), a retransmitted packet may be due earlier
+            self.timer = None
+        if self.in_flight:
+            deadline = min(packet.deadline for packet in self.in_flight.values())
+            self.timer = self.loop.call_later(max(0, deadline - now), self.retransmit)
+
+    def pending(self):
+        # The guaranteed packets not acknowledged yet, the ones in flight first, see resume()
+        return [packet.data for packet in self.in_flight.values()] + list(self.backlog or ())
+
+    def resume(self, packets):
+        # Carry on with the pending() packets of the server process this one replaced
+        # The ones that were in flight were sent already, they are only sent again once their timeout passes
+        for data in packets:
+            if len(self.in_flight) < max_in_flight:
+                packet = Unacked(data, self.clock.now, self.link.rto)
+                packet.retries = 1  # Karn's algorithm: we don't know when it was sent, so no round trip either
+                self.in_flight[sequence_id.unpack_from(data, 1)[0]] = packet
+            else:
+                self.send_guaranteed(data)
+
+        if self.in_flight and self.timer is None:
+            self.timer = self.loop.call_later(self.link.rto, self.retransmit)
+
+    def stop(self):
+        # The client left, nothing is sent to it anymore
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.in_flight.clear()
+        self.backlog = None
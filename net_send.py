@@ -0,0 +1,161 @@
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import socket
+import struct
+import sys
+
+log = logging.getLogger(__name__)
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+
+def load_sendmmsg():
+    # sendmmsg(2) sends many datagrams with one syscall, it only exists on Linux
+    if not sys.platform.startswith("linux"):
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+
+    sendmmsg.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int)
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+
+sendmmsg = load_sendmmsg()
+max_batch_size = 1024  # UIO_MAXIOV, the kernel doesn't send more messages per sendmmsg call
+batch_buffer_size = max_batch_size * 1500
+
+# Per datagram only these fields change, they are packed straight into the preallocated C arrays
+message_header = struct.Struct("PIPN")  # msg_name, msg_namelen, msg_iov, msg_iovlen at the start of a mmsghdr
+message_iov = struct.Struct("PN")  # iov_base, iov_len
+mmsghdr_size = ctypes.sizeof(mmsghdr)
+iovec_size = ctypes.sizeof(iovec)
+
+
+def c_array(size):
+    # A zeroed bytearray and the address of its memory, the bytearray is never resized so the address stays valid
+    array = bytearray(size)
+    return array, ctypes.addressof((ctypes.c_char * size).from_buffer(array))
+
+
+class SendQueue:
+    # Stands in for the server socket (or asyncio transport) wherever packets are sent, sendto() only queues
+    # the datagram and flush() sends everything queued during this loop tick in as few syscalls as possible
+    # The selector loop calls flush() after every tick, with an asyncio loop it is scheduled by the first sendto()
+    __slots__ = ("socket", "loop", "pending", "fileno", "addresses", "messages", "messages_address",
+                 "iovecs", "iovecs_address", "buffer", "buffer_address")
+
+    def __init__(self, sock, loop=None):
+        self.socket = sock
+        self.loop = loop
+        self.pending = []  # type: list[tuple[bytes, tuple]]
+        self.addresses = {}  # type: dict[tuple, tuple[ctypes.Array, int]]
+
+        # sendmmsg() is used on IPv4 sockets, anything else falls back to one sendto() per datagram
+        raw_socket = sock.get_extra_info("socket") if isinstance(sock, asyncio.BaseTransport) else sock
+        self.fileno = None
+        if sendmmsg and raw_socket.family == socket.AF_INET:
+            self.fileno = raw_socket.fileno()
+
+        # Reused by every flush: the mmsghdr array, one iovec per datagram and the datagrams copied back to back
+        self.messages, self.messages_address = c_array(mmsghdr_size * max_batch_size)
+        self.iovecs, self.iovecs_address = c_array(iovec_size * max_batch_size)
+        self.buffer, self.buffer_address = c_array(batch_buffer_size)
+
+    def sendto(self, data, addr):
+        if not self.pending and self.loop:
+            self.loop.call_soon(self.flush)
+        self.pending.append((data, addr))
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        pending, self.pending = self.pending, []
+        # A single datagram is cheaper with a plain sendto()
+        # Once an asyncio transport buffers datagrams it has to send everything else too, or they get reordered
+        if self.fileno is None or len(pending) == 1 or (self.loop and self.socket.get_write_buffer_size()):
+            self.send_each(pending)
+            return
+
+        if len(self.addresses) > 4096:
+            self.addresses.clear()
+
+        while pending:
+            count = self.fill_batch(pending)
+            self.send_batch(pending, count)
+            pending = pending[count:]
+
+    def fill_batch(self, pending):
+        # Pack datagrams into the batch until it runs out of messages or buffer space, returns how many fit
+        # A datagram relayed to several players is copied once and its messages share one iovec
+        addresses, buffer, messages, iovecs = self.addresses, self.buffer, self.messages, self.iovecs
+        count = 0
+        offset = 0
+        iov = -iovec_size
+        last_data = None
+        for data, addr in pending:
+            if count == max_batch_size:
+                break
+
+            if data is not last_data:
+                size = len(data)
+                if offset + size > batch_buffer_size:
+                    break
+                buffer[offset:offset + size] = data
+                iov += iovec_size
+                message_iov.pack_into(iovecs, iov, self.buffer_address + offset, size)
+                offset += size
+                last_data = data
+
+            address = addresses.get(addr) or self.sockaddr(addr)
+            message_header.pack_into(messages, count * mmsghdr_size, address[1], 16, self.iovecs_address + iov, 1)
+            count += 1
+
+        return count
+
+    def send_batch(self, pending, count):
+        sent = 0
+        while sent < count:
+            result = sendmmsg(self.fileno, self.messages_address + sent * mmsghdr_size, count - sent, 0)
+            if result < 0:
+                # The first unsent datagram failed, send it on its own to raise or drop it and carry on after it
+                self.send_each(pending[sent:sent + 1])
+                sent += 1
+            else:
+                sent += result
+
+    def send_each(self, pending):
+        for data, addr in pending:
+            try:
+                self.socket.sendto(data, addr)
+            except OSError as e:
+                # A full socket buffer drops the datagram, like the network would
+                log.debug("Dropped datagram to %s: %s", addr, e)
+
+    def sockaddr(self, addr):
+        # struct sockaddr_in for an (ip, port) tuple and its address, cached per player address
+        host, port = addr
+        address = ctypes.create_string_buffer(struct.pack("=H", socket.AF_INET) + struct.pack("!H", port) +
+                                              socket.inet_aton(host) + bytes(8), 16)
+        self.addresses[addr] = address, ctypes.addressof(address)
+        return self.addresses[addr]
@@ -0,0 +1,92 @@
+import logging
+import os
+import socket
+import struct
+import tempfile
+
+log = logging.getLogger(__name__)
+
+# The games a restarting server hands over to the process replacing it, see uads.hot_restart() and uads.hand_over()
+# A header followed by every game, each game is followed by its players and each player by the guaranteed packets
+# the client hasn't acknowledged yet
+# Only the replacing process reads it, so the format can change between versions as long as both sides agree
+snapshot_header = struct.Struct("<4sHI")  # magic, version, number of games
+snapshot_magic = b"UADS"
+snapshot_version = 3
+# game_id, level_number, locked, started, milliseconds since the game started, number of players
+snapshot_game = struct.Struct("<QIBBIB")
+# player_id, ip, port, packet sequence, faction, ready is known, ready, crc (-1 for unknown), is host,
+# length of the player name following the struct, number of unacknowledged packets following the name
+# ready is the unsigned byte of the client's UAMSG_READY, so it can't have a sentinel value of its own
+snapshot_player = struct.Struct("<Q4sHIHBBqBBH")
+snapshot_packet = struct.Struct("<I")  # Size of the unacknowledged packet following it
+
+
+def snapshot_path():
+    return os.path.join(tempfile.gettempdir(), f"uads-{os.getpid()}.snapshot")
+
+
+def save(path, games):
+    with open(path, "wb") as snapshot_file:
+        snapshot_file.write(pack(games))
+
+
+def load(path):
+    # Returns the games save() wrote and deletes the file, so a later restart can't restore them twice
+    with open(path, "rb") as snapshot_file:
+        data = snapshot_file.read()
+    os.unlink(path)
+
+    games = unpack(data)
+    if games is None:
+        log.warning("Ignoring snapshot %s with unknown format", path)
+        return []
+    return games
+
+
+def pack(games):
+    # games is a list of (game_id, level_number, locked, started, elapsed seconds, players) and players a list of
+    # (player_id, (ip, port), player_name, (faction, ready, crc, packet sequence), is host, unacknowledged packets)
+    data = bytearray(snapshot_header.pack(snapshot_magic, snapshot_version, len(games)))
+    for game_id, level_number, locked, started, elapsed, players in games:
+        data += snapshot_game.pack(game_id, level_number, locked, started, int(elapsed * 1000), len(players))
+        for player_id, (host, port), player_name, player_state, is_host, unacked in players:
+            faction, ready, crc, packet_sequence = player_state
+            name = player_name.encode()[:255]
+            data += snapshot_player.pack(player_id, socket.inet_aton(host), port, packet_sequence, faction,
+                                         ready is not None, ready or 0, -1 if crc is None else crc, is_host,
+                                         len(name), len(unacked))
+            data += name
+            for packet in unacked:
+                data += snapshot_packet.pack(len(packet))
+                data += packet
+    return data
+
+
+def unpack(data):
+    # Returns the games pack() packed, None if data was packed by a version that packs them differently
+    magic, version, game_count = snapshot_header.unpack_from(data)
+    if magic != snapshot_magic or version != snapshot_version:
+        return None
+
+    games = []
+    offset = snapshot_header.size
+    for _ in range(game_count):
+        game_id, level_number, locked, started, elapsed, player_count = snapshot_game.unpack_from(data, offset)
+        offset += snapshot_game.size
+        players = []
+        for _ in range(player_count):
+            (player_id, host, port, packet_sequence, faction, ready_known, ready, crc, is_host, name_size,
+             packet_count) = snapshot_player.unpack_from(data, offset)
+            offset += snapshot_player.size + name_size
+            player_name = bytes(data[offset - name_size:offset]).decode(errors="replace")
+            unacked = []
+            for _ in range(packet_count):
+                packet_size = snapshot_packet.unpack_from(data, offset)[0]
+                offset += snapshot_packet.size + packet_size
+                unacked.append(bytes(data[offset - packet_size:offset]))
+            player_state = (faction, ready if ready_known else None, None if crc == -1 else crc, packet_sequence)
+            players.append((player_id, (socket.inet_ntoa(host), port), player_name, player_state, bool(is_host),
+                            unacked))
+        games.append((game_id, level_number, bool(locked), bool(started), elapsed / 1000, players))
+    return games
@@ -0,0 +1,114 @@
+import heapq
+import time
+
+
+class Clock:
+    # Monotonic time read once per loop wakeup, everything handled during the wakeup sees the same time
+    # Unlike time.time() it doesn't jump when the system clock is set, so a clock step can't kick idle players
+    __slots__ = ("now",)
+
+    def __init__(self):
+        self.now = time.monotonic()
+
+    def tick(self):
+        self.now = time.monotonic()
+        return self.now
+
+    def millis(self, since=0.0):
+        # Milliseconds from since (an earlier now) to now, wrapped to fit the 32 bit timestamps of the protocol
+        return int((self.now - since) * 1000) & 0xFFFFFFFF
+
+
+class AsyncioTimers:
+    # call_later() of an asyncio loop for the games of UAMPServerProtocol
+    # asyncio calls every timer on its own, each is a wakeup the clock is ticked for, like the selector loop ticks
+    # it once per wakeup, so the callbacks only read clock.now in both server modes
+    __slots__ = ("loop", "clock")
+
+    def __init__(self, loop, clock):
+        self.loop = loop  # type: asyncio.AbstractEventLoop
+        self.clock = clock  # type: Clock
+
+    def call_later(self, delay, callback, *args):
+        return self.loop.call_later(delay, self.run, callback, args)
+
+    def run(self, callback, args):
+        self.clock.tick()
+        callback(*args)
+
+
+class TimerHandle:
+    # Returned by TimerQueue.call_later()/call_at(), like asyncio.TimerHandle
+    __slots__ = ("when", "callback", "args", "cancelled", "queue")
+
+    def __init__(self, when, callback, args, queue):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.queue = queue
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        # The handle stays in the heap and is skipped when it comes up
+        if not self.cancelled:
+            self.cancelled = True
+            self.queue.cancelled += 1
+
+
+class TimerQueue:
+    # Deadline ordered callbacks for the selector loop, with the call_later()/call_at() API of an asyncio loop
+    # so UAMPGame can schedule its ping and kick timers the same way in both server modes
+    # Only due timers cost anything: the loop sleeps until timeout() and run() pops what is due
+    # Time is the clock's, ticked by the loop once per wakeup, so timers are due at most one tick late
+    __slots__ = ("clock", "heap", "cancelled")
+
+    def __init__(self, clock):
+        self.clock = clock  # type: Clock
+        self.heap = []  # type: list[TimerHandle]
+        self.cancelled = 0  # Cancelled handles still in the heap
+
+    def time(self):
+        return self.clock.now
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        handle = TimerHandle(when, callback, args, self)
+        heapq.heappush(self.heap, handle)
+        return handle
+
+    def timeout(self):
+        # Seconds until the next timer is due, None when there is none
+        self.drop_cancelled()
+        if not self.heap:
+            return None
+        return max(0, self.heap[0].when - self.time())
+
+    def run(self):
+        # Call every timer that is due, timers scheduled by the callbacks wait for the next run()
+        now = self.time()
+        due = []
+        while self.heap and self.heap[0].when <= now:
+            due.append(heapq.heappop(self.heap))
+
+        for handle in due:
+            if handle.cancelled:
+                self.cancelled -= 1
+            else:
+                handle.cancelled = True  # Cancelling a timer that already ran does nothing
+                handle.callback(*handle.args)
+
+    def drop_cancelled(self):
+        while self.heap and self.heap[0].cancelled:
+            heapq.heappop(self.heap)
+            self.cancelled -= 1
+
+        # Rebuild the heap once cancelled handles pile up in the middle of it
+        if self.cancelled > 64 and self.cancelled > len(self.heap) // 2:
+            self.heap = [handle for handle in self.heap if not handle.cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
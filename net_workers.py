@@ -0,0 +1,282 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.shared_memory
+import os
+import signal
+import socket
+import struct
+import sys
+
+log = logging.getLogger(__name__)
+
+# Messages between workers, sent over each worker's Unix datagram socket
+# Messages are queued and flushed once per loop tick, each Unix datagram carries all the messages for one worker
+# Every message starts with control_header: kind, a worker index, the address of the client it is about and
+# the size of the payload following the header
+ROUTE_DATAGRAM = 1  # A client datagram received by another worker for a player in one of our games
+ROUTE_PLAYER = 2  # The player now plays on the given worker (or none), send their datagrams there
+ROUTE_MIGRATE = 3  # A player moving into one of our games, the worker is the one receiving the player's datagrams
+
+control_header = struct.Struct("<BB4sHH")  # kind, worker, client ip, client port, payload size
+# game_id, player_id, packet sequence, faction, ready is known, ready, crc (-1 for unknown), then the player name
+# ready is the unsigned byte of the client's UAMSG_READY, so it can't have a sentinel value of its own
+migrate_payload = struct.Struct("<QQIHBBq")
+no_worker = 255
+max_batch_size = 60000  # Bytes per Unix datagram, the default socket buffer takes about 200KB
+
+# Rows of the shared game directory, see GameDirectory
+game_row = struct.Struct("<IQIBBB5x")  # sequence, game_id, level_number, players, max players, flags
+row_sequence = struct.Struct("<I")
+rows_used = struct.Struct("<I")  # Rows of a worker's partition ever used, the header holds one for each worker
+rows_per_worker = 256
+GAME_LIVE = 1
+GAME_LOCKED = 2
+GAME_STARTED = 4
+
+
+class GameDirectory:
+    # Every live game of every worker, in shared memory so any worker can look games up without asking the others
+    # Each worker only writes the rows of its own partition and every row is guarded by a sequence lock:
+    # the writer makes the sequence odd while it changes the row, readers retry a row whose sequence was odd
+    # or changed while they read it, so reads never block and never see a half written row
+    __slots__ = ("memory", "buffer", "workers", "index", "rows", "free_rows")
+
+    def __init__(self, memory, workers, index):
+        self.memory = memory  # type: multiprocessing.shared_memory.SharedMemory
+        self.buffer = memory.buf
+        self.workers = workers
+        self.index = index  # The partition this worker writes
+        self.rows = {}  # type: dict[int, int]  # game_id -> row of our games
+        self.free_rows = []  # Rows of our partition that were used before and are free again, lowest last
+
+    @staticmethod
+    def size(workers):
+        return workers * (rows_used.size + rows_per_worker * game_row.size)
+
+    def publish(self, game_id, level_number, players, max_players, locked, started):
+        row = self.rows.get(game_id)
+        if row is None:
+            row = self.allocate_row()
+            if row is None:
+                log.warning("Game directory is full, game %s can't be found by other workers", game_id)
+                return
+            self.rows[game_id] = row
+
+        flags = GAME_LIVE | (GAME_LOCKED if locked else 0) | (GAME_STARTED if started else 0)
+        self.write_row(row, game_id, level_number, players, max_players, flags)
+
+    def unpublish(self, game_id):
+        row = self.rows.pop(game_id, None)
+        if row is not None:
+            self.write_row(row, 0, 0, 0, 0, 0)
+            self.free_rows.append(row)
+            self.free_rows.sort(reverse=True)
+
+    def allocate_row(self):
+        # Reuse the lowest free row so readers only scan the start of each partition
+        if self.free_rows:
+            return self.free_rows.pop()
+
+        used = rows_used.unpack_from(self.buffer, self.index * rows_used.size)[0]
+        if used == rows_per_worker:
+            return None
+        rows_used.pack_into(self.buffer, self.index * rows_used.size, used + 1)
+        return self.index * rows_per_worker + used
+
+    def write_row(self, row, *fields):
+        offset = self.row_offset(row)
+        sequence = row_sequence.unpack_from(self.buffer, offset)[0]
+        row_sequence.pack_into(self.buffer, offset, (sequence + 1) & 0xFFFFFFFF)
+        game_row.pack_into(self.buffer, offset, (sequence + 1) & 0xFFFFFFFF, *fields)
+        row_sequence.pack_into(self.buffer, offset, (sequence + 2) & 0xFFFFFFFF)
+
+    def row_offset(self, row):
+        return self.workers * rows_used.size + row * game_row.size
+
+    def games(self):
+        # Yields (worker, game_id, level_number, players, max players, locked, started) of every live game
+        for worker in range(self.workers):
+            first_row = worker * rows_per_worker
+            used = rows_used.unpack_from(self.buffer, worker * rows_used.size)[0]
+            for row in range(first_row, first_row + used):
+                offset = self.row_offset(row)
+                while True:
+                    sequence, game_id, level_number, players, max_players, flags = game_row.unpack_from(self.buffer,
+                                                                                                       offset)
+                    if not sequence & 1 and row_sequence.unpack_from(self.buffer, offset)[0] == sequence:
+                        break
+
+                if flags & GAME_LIVE:
+                    yield (worker, game_id, level_number, players, max_players,
+                           bool(flags & GAME_LOCKED), bool(flags & GAME_STARTED))
+
+
+class Worker:
+    # One of several server processes sharing the port with SO_REUSEPORT
+    # The kernel picks the worker receiving a client's datagrams from the client address, but a player can be
+    # placed in a game of another worker: the receiving worker forwards the datagrams to the game's worker,
+    # which answers the client directly from its own socket bound to the same port
+    __slots__ = ("index", "name", "socket", "directory", "routes", "receivers", "pending")
+
+    def __init__(self, index, name, sock, directory):
+        self.index = index
+        self.name = name  # Prefix of the workers' socket addresses
+        self.socket = sock  # Our bound Unix datagram socket
+        self.directory = directory  # type: GameDirectory  # The live games of all workers
+        self.routes = {}  # type: dict[tuple, int]  # Players we receive for, playing on another worker
+        self.receivers = {}  # type: dict[tuple, int]  # Players playing here, received by another worker
+        self.pending = {}  # type: dict[int, list]  # Header and payload buffers queued for each worker
+
+    def forward(self, index, player_addr_port, data):
+        self.send(index, ROUTE_DATAGRAM, player_addr_port, self.index, data)
+
+    def send(self, index, kind, player_addr_port, worker=no_worker, payload=b""):
+        # Queue a message, the payload is only referenced until flush(), like a net_send.SendQueue
+        host, port = player_addr_port
+        header = control_header.pack(kind, worker, socket.inet_aton(host), port, len(payload))
+        self.pending.setdefault(index, []).extend((header, payload))
+
+    def flush(self):
+        # Send the queued messages, as few Unix datagrams as possible for each worker
+        pending, self.pending = self.pending, {}
+        for index, buffers in pending.items():
+            start = 0
+            size = 0
+            for i in range(0, len(buffers), 2):
+                message_size = len(buffers[i]) + len(buffers[i + 1])
+                if size + message_size > max_batch_size:
+                    self.send_batch(index, buffers[start:i])
+                    start = i
+                    size = 0
+                size += message_size
+            self.send_batch(index, buffers[start:])
+
+    def send_batch(self, index, buffers):
+        try:
+            self.socket.sendmsg(buffers, (), 0, worker_address(self.name, index))
+        except OSError as e:
+            # A full socket buffer drops the forwarded datagrams, like the network would, but the other messages
+            # move players between workers and are sent again with the next flush: a lost ROUTE_MIGRATE would
+            # lose the player, who already left their old game
+            log.debug("Couldn't send to worker %s: %s", index, e)
+            for i in range(0, len(buffers), 2):
+                if buffers[i][0] != ROUTE_DATAGRAM:
+                    self.pending.setdefault(index, []).extend(buffers[i:i + 2])
+
+    def parse(self, data):
+        # Yields kind, worker, client address and payload of each message in a datagram received on our socket
+        offset = 0
+        while offset < len(data):
+            kind, worker, host, port, size = control_header.unpack_from(data, offset)
+            offset += control_header.size + size
+            yield kind, worker, (socket.inet_ntoa(host), port), data[offset - size:offset]
+
+    def open_games(self):
+        # Yields (worker, game_id, open slots) of the games of every worker, open slots is 0 when a game is full
+        for index, game_id, level_number, players, max_players, locked, started in self.directory.games():
+            yield index, game_id, 0 if locked or started else max(0, max_players - players)
+
+    def game_owner(self, game_id):
+        # (worker, open slots) of any live game, None if no worker has it
+        for index, other_game_id, open_slots in self.open_games():
+            if other_game_id == game_id:
+                return index, open_slots
+        return None
+
+    def find_open_game(self):
+        # The worker whose game has the fewest free slots, like find_open_game() does within a worker
+        best = None
+        for index, game_id, open_slots in self.open_games():
+            if index != self.index and open_slots and (best is None or open_slots < best[1]):
+                best = (index, open_slots)
+        return best and best[0]
+
+    def player_left(self, player_addr_port):
+        # Stop the receiving worker from forwarding the player's datagrams to us
+        receiver = self.receivers.pop(player_addr_port, None)
+        if receiver is not None:
+            self.send(receiver, ROUTE_PLAYER, player_addr_port, no_worker)
+
+    def move_player(self, player_addr_port, index, game_id, player_id, player_name, player_state):
+        # Hand a player that just left one of our games over to the game_id game of worker index
+        # player_state is (faction, ready, crc, packet sequence), see UAMPClient.state()
+        # The message goes out with this tick's flush, the player is in the new game before the client notices
+        faction, ready, crc, packet_sequence = player_state
+        payload = migrate_payload.pack(game_id, player_id, packet_sequence, faction, ready is not None, ready or 0,
+                                       -1 if crc is None else crc)
+        receiver = self.receivers.pop(player_addr_port, self.index)
+        self.send(index, ROUTE_MIGRATE, player_addr_port, receiver, payload + player_name.encode())
+
+        # The receiving worker has to forward the player's datagrams to the new worker from now on
+        # Datagrams already on their way to us are dropped, the client sends guaranteed ones again
+        if receiver == self.index:
+            self.routes[player_addr_port] = index
+        elif receiver != index:
+            self.send(receiver, ROUTE_PLAYER, player_addr_port, index)
+
+    def player_joined(self, player_addr_port, receiver):
+        # A player moved into one of our games, see move_player()
+        if receiver == self.index:
+            self.routes.pop(player_addr_port, None)
+        else:
+            self.receivers[player_addr_port] = receiver
+
+    def parse_migration(self, payload):
+        # Returns game_id, player_id, player_name and player_state of a ROUTE_MIGRATE message
+        game_id, player_id, packet_sequence, faction, ready_known, ready, crc = migrate_payload.unpack_from(payload)
+        player_name = bytes(payload[migrate_payload.size:]).decode(errors="replace")
+        player_state = (faction, ready if ready_known else None, None if crc == -1 else crc, packet_sequence)
+        return game_id, player_id, player_name, player_state
+
+
+def worker_address(name, index):
+    # Linux abstract socket namespace, nothing to clean up on disk
+    return f"\0{name}-{index}"
+
+
+def supervise(count, run):
+    # Fork count workers and call run(worker) in each of them, which serves until the worker exits
+    # When one worker exits the others are stopped, so a process manager restarts the whole server
+    context = multiprocessing.get_context("fork")
+    name = f"uads-{os.getpid()}"
+
+    # Bind every worker's socket before forking, so no worker can send to another that isn't listening yet
+    sockets = []
+    for index in range(count):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.bind(worker_address(name, index))
+        sockets.append(sock)
+
+    # The workers inherit the mapping when they are forked
+    memory = multiprocessing.shared_memory.SharedMemory(create=True, size=GameDirectory.size(count))
+    processes = [context.Process(target=run_worker, args=(run, index, name, sockets, memory, count),
+                                 name=f"worker-{index}")
+                 for index in range(count)]
+    for process in processes:
+        process.start()
+    for sock in sockets:
+        sock.close()
+
+    # Stopping the supervisor stops the workers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    try:
+        multiprocessing.connection.wait([process.sentinel for process in processes])
+        return next(process.exitcode for process in processes if process.exitcode is not None)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        memory.close()
+        memory.unlink()
+
+
+def run_worker(run, index, name, sockets, memory, count):
+    for i, sock in enumerate(sockets):
+        if i != index:
+            sock.close()
+
+    run(Worker(index, name, sockets[index], GameDirectory(memory, count, index)))
@@ -1,12 +1,28 @@
-import binascii
+import argparse
+import asyncio
+import logging
+import os
 import random
+import selectors
 import socket
-import time
+import struct
+import sys
+import textwrap
 import uuid
 
 import net_classes
 import net_games
+import net_handoff
+import net_log
 import net_messages
+import net_reassembly
+import net_reliable
+import net_send
+import net_snapshot
+import net_timers
+import net_workers
+
+log = logging.getLogger(__name__)
 
 
 class RestartServer(Exception):
@@ -14,13 +30,18 @@ class RestartServer(Exception):
 
 
 class UAMPClient:
-    def __init__(self, sock, game_id, player_name, remote_addr, remote_port, player_id=None):
+    __slots__ = ("socket", "clock", "remote_addr", "remote_port", "packet_sequence", "last_ping_time",
+                 "last_packet_time", "game_id", "player_name", "is_host", "faction", "crc", "ready", "player_id",
+                 "timers", "link", "pacer", "reliable", "received")
+
+    def __init__(self, sock, loop, clock, game_id, player_name, remote_addr, remote_port, player_id=None):
         self.socket = sock
+        self.clock = clock  # type: net_timers.Clock
         self.remote_addr = remote_addr
         self.remote_port = remote_port
         self.packet_sequence = 0  # The last packet number that we sent to the client
-        self.last_ping_time = 0  # The time.time() when we last sent a ping to this client
-        self.last_packet_time = time.time()  # The time.time() when we last received a packet from this client
+        self.last_ping_time = 0  # The clock time when we last sent a ping to this client
+        self.last_packet_time = clock.now  # The clock time when we last received a packet from this client
         self.game_id = game_id
 
         self.player_name = player_name
@@ -29,29 +50,27 @@ class UAMPClient:
         self.crc = None  # The reported checksum of game files on disk
         self.ready = None  # If the player is ready
         self.player_id = player_id or ((random.randrange(2 ** 32) << 16) + 0xBBBB) | 0xAAAA000000000000
-
-    def should_ping(self):
-        if int(time.time()) - self.last_ping_time > 2:
-            return True
-        return False
-
-    def should_kick(self):
-        if int(time.time()) - self.last_packet_time > 10:
-            return True
-        return False
+        self.timers = []  # Loop callbacks (ping/kick) that must be cancelled when the player leaves the game
+        self.link = net_reliable.LinkEstimator()  # Round trip time, jitter and loss of the connection
+        self.pacer = net_reliable.Pacer(sock, (remote_addr, remote_port), loop, self.link)  # Spreads out parts
+        self.reliable = net_reliable.ReliableQueue(self.send_now, loop, clock, self.link)  # Guaranteed packets
+        self.received = net_reliable.SequenceWindow()  # Guaranteed packets received, to skip the client's repeats
 
     def send_ping(self, game_started, time_stamp):
-        self.last_ping_time = int(time.time())
+        self.last_ping_time = self.clock.now
         if game_started:
             # print("Sending UAMessageRequestPing")
+            # The client answers with a UAMSG_PONG carrying timestamp back, see UAMPGame.packet_received()
             ping = net_classes.UAMessageRequestPing(to_id=self.player_id,
                                                     from_id=self.game_id,
                                                     sequence_id=self.next_pkt_seq(),
+                                                    timestamp=self.clock.millis(),
                                                     my_timestamp=time_stamp)
             self.send_packet(ping)
 
         # print("Sending NetSysPing")
         ping = net_classes.NetSysPing(sequence_id=self.next_pkt_seq())
+        self.link.ping_sent(ping.sequence_id, self.clock.now)
         self.send_packet(ping)
 
     def next_pkt_seq(self):
@@ -59,26 +78,62 @@ class UAMPClient:
         return self.packet_sequence
 
     def inspect_packet(self, packet):
-        self.last_packet_time = int(time.time())
+        self.last_packet_time = self.clock.now
+        if not packet.packet_flags & net_messages.PKT_FLAG_SYSTEM:
+            self.link.received(packet.sequence_id)
         # Inspect the packet to update any instance variables
         # We might want to keep track of such as last_packet_time
         if isinstance(packet, net_classes.UAMessageFaction):
-            print(f"{self.player_name} is changing faction to number {packet.new} from {packet.old}")
+            log.info("%s is changing faction to number %s from %s", self.player_name, packet.new, packet.old)
             self.faction = packet.new
 
     def send_packet(self, packet):
         # We need to send something to this client
-        self.socket.sendto(packet.data, (self.remote_addr, self.remote_port))
-        pass
+        self.send_data(packet.data)
+
+    def send_data(self, data):
+        # Send an already serialized packet, guaranteed ones are sent again until the client acknowledges them
+        if net_reliable.ReliableQueue.is_guaranteed(data):
+            self.reliable.send_guaranteed(data)
+        else:
+            self.send_now(data)
+
+    def relay_data(self, data):
+        # Send a packet of another player, we acked it for this client so it's ours to deliver
+        # Guaranteed packets get a sequence_id of ours, the client's ack can then only mean this copy
+        if net_reliable.ReliableQueue.is_guaranteed(data):
+            data = bytearray(data)
+            net_reliable.sequence_id.pack_into(data, 1, self.next_pkt_seq())
+            self.reliable.send_guaranteed(data)
+        else:
+            self.send_now(data)
+
+    def send_now(self, data):
+        # Packets too big for one datagram go out in parts, IP fragments would lose the packet with any fragment
+        if len(data) > max_datagram_size and not data[0] & net_messages.PKT_FLAG_SYSTEM:
+            self.pacer.send_all(net_classes.Part.split(data, max_datagram_size))
+        else:
+            self.pacer.send(data)
 
     def send_message(self, message):
+        log.info("> SERVER: %s", message)
         message = "> SERVER: " + message
-        print(message)
-        pkt = net_classes.UAMessageMessage(from_id=self.player_id,
-                                           to_id=self.game_id,
-                                           sequence_id=self.next_pkt_seq(),
-                                           message=message)
-        self.send_packet(pkt)
+        # The message field holds 63 characters and a terminating zero, longer messages are sent as several lines
+        for line in textwrap.wrap(message, width=63, subsequent_indent="  ") or [message]:
+            pkt = net_classes.UAMessageMessage(from_id=self.player_id,
+                                               to_id=self.game_id,
+                                               sequence_id=self.next_pkt_seq(),
+                                               message=line)
+            self.send_packet(pkt)
+
+    def state(self):
+        # What a player keeps when moving to another game, see UAMPGame.add_player()
+        return self.faction, self.ready, self.crc, self.packet_sequence
+
+    def delivered(self, sequence_id):
+        # The client acknowledged one of our packets with a NetSysDelivered
+        if not self.link.delivered(sequence_id, self.clock.now):
+            self.reliable.delivered(sequence_id)
 
     def make_host(self):
         self.is_host = True
@@ -88,15 +143,22 @@ class UAMPClient:
 
 
 class UAMPGame:
-    def __init__(self, sock):
+    __slots__ = ("socket", "loop", "clock", "game_id", "level_number", "game_started", "game_locked", "game_start_time",
+                 "players", "parts", "open_slots", "games")
+
+    def __init__(self, sock, loop, clock, games):
         self.socket = sock
+        self.loop = loop  # Runs the ping and kick timers, an asyncio loop or a net_timers.TimerQueue
+        self.clock = clock  # type: net_timers.Clock  # Ticked by the server loop, shared with the players
         self.game_id = uuid.uuid4().fields[5]
         self.level_number = 93
         self.game_started = False
         self.game_locked = False
-        self.game_start_time = 0
+        self.game_start_time = 0.0  # The clock time the game was started
         self.players = {}  # type: dict[tuple, UAMPClient]
-        self.multi_part_packets = {}
+        self.parts = net_reassembly.Reassembler(loop, clock)  # Packets the players send in parts
+        self.open_slots = 0  # The open_games bucket this game is filed under, 0 when it can't take players
+        self.games = games  # type: list[UAMPGame]  # The games this one is listed in, it leaves once it's over
 
     def __iter__(self):
         # This lets us do cool stuff like `if player in game`
@@ -105,8 +167,9 @@ class UAMPGame:
 
     @property
     def time_stamp(self):
+        # Milliseconds since the game started
         if self.game_started:
-            return int(time.time()) - self.game_start_time
+            return self.clock.millis(self.game_start_time)
         return 0
 
     @property
@@ -127,11 +190,43 @@ class UAMPGame:
 
         return 4  # HACK for MD or custom levels
 
-    def check_game(self):
-        for player in self.players.copy().values():
-            if player.should_kick():
-                self.kick_player(player)
-                self.message_all_players(f"{player.player_name} has been kicked from game")
+    def update_open_games(self):
+        # Re-file this game under its number of free slots so handshakes can be placed without scanning every game
+        # Call this whenever players join or leave, or the game is locked, started or changes level
+        if self.open_slots:
+            del open_games[self.open_slots][self.game_id]
+
+        self.open_slots = 0 if self.is_full() else self.max_players() - self.num_players
+        if self.open_slots:
+            open_games.setdefault(self.open_slots, {})[self.game_id] = self
+        if worker:
+            worker.directory.publish(self.game_id, self.level_number, self.num_players, self.max_players(),
+                                     self.game_locked, self.game_started)
+
+    def start_player_timers(self, player):
+        player.timers = [self.loop.call_later(ping_interval, self.ping_player, player),
+                         self.loop.call_later(kick_timeout, self.kick_idle_player, player)]
+
+    def stop_player_timers(self, player):
+        for timer in player.timers:
+            timer.cancel()
+        player.timers = []
+        player.reliable.stop()
+        player.pacer.stop()
+
+    def ping_player(self, player):
+        player.send_ping(game_started=self.game_started, time_stamp=self.time_stamp)
+        player.timers[0] = self.loop.call_later(ping_interval, self.ping_player, player)
+
+    def kick_idle_player(self, player):
+        # Packets don't touch the timer, we just push the deadline back if something arrived meanwhile
+        idle_time = self.clock.now - player.last_packet_time
+        if idle_time <= kick_timeout:
+            player.timers[1] = self.loop.call_later(kick_timeout - idle_time + 1, self.kick_idle_player, player)
+            return
+
+        self.kick_player(player)
+        self.message_all_players(f"{player.player_name} has been kicked from game")
 
     def kick_player_by_index(self, i):
         player_list = list(self.players.values())
@@ -148,15 +243,32 @@ class UAMPGame:
         if not reconnecting:
             player.send_packet(net_classes.NetSysDisconnected())
         self.players.pop((player.remote_addr, player.remote_port))
+        all_players.pop((player.remote_addr, player.remote_port), None)
+        self.parts.forget((player.remote_addr, player.remote_port))
+        self.stop_player_timers(player)
+        if worker and not reconnecting:
+            worker.player_left((player.remote_addr, player.remote_port))
+
+        self.update_open_games()
+        if self.game_started and self.game_finished:
+            # Nobody can join a started game, it's over once everybody left
+            # Not right away, the caller may be going through the games
+            self.loop.call_later(0, self.purge)
 
         if player.is_host and self.num_players > 0:
             next_host = next(iter(self.players.values()))
             next_host.make_host()
 
-        player_left_message = net_classes.NetUsrDisconnect(player_id=player.player_id,
-                                                           sequence_id=player.next_pkt_seq())
+        player_left_message = net_classes.Broadcast(net_classes.NetUsrDisconnect(player_id=player.player_id))
         for player in self.players.values():
-            player.send_packet(player_left_message)
+            player.send_data(player_left_message.data(player.next_pkt_seq()))
+
+    def purge(self):
+        if self in self.games:
+            log.info("Purging game %s with no players", self.game_id)
+            self.games.remove(self)
+            if worker:
+                worker.directory.unpublish(self.game_id)
 
     def kick_all_players(self):
         for player in self.players.copy().values():
@@ -172,11 +284,8 @@ class UAMPGame:
 
         return temp_name
 
-    def add_player(self, player_name, player_addr_port, player_id=None):
-        remote_addr, remote_port = player_addr_port
-        new_player = UAMPClient(sock=self.socket, game_id=self.game_id, player_name=self.player_name_clean(player_name),
-                                remote_addr=remote_addr, remote_port=remote_port, player_id=player_id)
-        self.players[player_addr_port] = new_player
+    def add_player(self, player_name, player_addr_port, player_id=None, player_state=None):
+        new_player = self.join(player_name, player_addr_port, player_id, player_state)
 
         new_player.send_packet(net_classes.NetSysConnected(client_name=new_player.player_name,
                                                            client_id=new_player.player_id))
@@ -186,16 +295,15 @@ class UAMPGame:
         if self.num_players == 1:
             new_player.make_host()
 
+        # Everybody gets the same session list and welcome, only the sequence numbers and player ids are patched
         players = {player.player_name: player.player_id for player in self.players.values()}
+        session_list = net_classes.Broadcast(net_classes.NetUsrSessionList(users=players))
+        welcome = net_classes.Broadcast(net_classes.UAMessageWelcome(to_id=0, from_id=new_player.player_id))
+        welcome_back = net_classes.Broadcast(net_classes.UAMessageWelcome(to_id=new_player.player_id, from_id=0))
         for player in self.players.values():
-            player.send_packet(net_classes.NetUsrSessionList(users=players,
-                                                             sequence_id=player.next_pkt_seq()))
-            player.send_packet(net_classes.UAMessageWelcome(to_id=player.player_id,
-                                                            from_id=new_player.player_id,
-                                                            sequence_id=player.next_pkt_seq()))
-            new_player.send_packet(net_classes.UAMessageWelcome(to_id=new_player.player_id,
-                                                                from_id=player.player_id,
-                                                                sequence_id=new_player.next_pkt_seq()))
+            player.send_data(session_list.data(player.next_pkt_seq()))
+            player.send_data(welcome.data(player.next_pkt_seq(), packet_to=player.player_id))
+            new_player.send_data(welcome_back.data(new_player.next_pkt_seq(), packet_from=player.player_id))
             # player.send_packet(net_classes.UAMessageCRC(to_id=player.player_id,
             #                                            from_id=new_player.player_id,
             #                                            sequence_id=player.next_pkt_seq()))
@@ -205,8 +313,31 @@ class UAMPGame:
 
         return new_player
 
+    def join(self, player_name, player_addr_port, player_id=None, player_state=None):
+        # Seat a player without telling anybody, add_player() does the talking
+        remote_addr, remote_port = player_addr_port
+        new_player = UAMPClient(sock=self.socket, loop=self.loop, clock=self.clock, game_id=self.game_id,
+                                player_name=self.player_name_clean(player_name), remote_addr=remote_addr,
+                                remote_port=remote_port, player_id=player_id)
+        if player_state:
+            # A player moving in from another game keeps their settings and the sequence numbers the client expects
+            new_player.faction, new_player.ready, new_player.crc, new_player.packet_sequence = player_state
+        self.players[player_addr_port] = new_player
+        all_players[player_addr_port] = self
+        self.update_open_games()
+        self.start_player_timers(new_player)
+        return new_player
+
+    def snapshot(self):
+        # What a restarted server needs to carry on with this game, see net_snapshot.save()
+        elapsed = self.clock.now - self.game_start_time if self.game_started else 0
+        players = [(player.player_id, (player.remote_addr, player.remote_port), player.player_name, player.state(),
+                    player.is_host, player.reliable.pending()) for player in self.players.values()]
+        return self.game_id, self.level_number, self.game_locked, self.game_started, elapsed, players
+
     def change_level(self, game_level_id):
         self.level_number = game_level_id
+        self.update_open_games()
         for player in self.players.values():
             player.send_packet(net_classes.NetSysSessionJoin(game_id=self.game_id,
                                                              level_number=self.level_number,
@@ -238,9 +369,13 @@ class UAMPGame:
         return has_conflict
 
     def message_all_players(self, message):
-        for player in self.players.values():
-            player.send_message(message=message)
-        return
+        log.info("> SERVER: %s", message)
+        message = "> SERVER: " + message
+        # Server messages are sent as if they came from the player reading them, wrapped like send_message() does
+        for line in textwrap.wrap(message, width=63, subsequent_indent="  ") or [message]:
+            pkt = net_classes.Broadcast(net_classes.UAMessageMessage(from_id=0, to_id=self.game_id, message=line))
+            for player in self.players.values():
+                player.send_data(pkt.data(player.next_pkt_seq(), packet_from=player.player_id))
 
     def start_game(self):
         # For each player, send UAMessageLoadGame()
@@ -256,7 +391,8 @@ class UAMPGame:
             return False
 
         self.game_started = True
-        self.game_start_time = int(time.time())
+        self.game_start_time = self.clock.now
+        self.update_open_games()
 
         for player in self.players.values():
             msg = net_classes.UAMessageLoadGame(to_id=player.player_id,
@@ -274,29 +410,37 @@ class UAMPGame:
         player = self.players[player_addr_port]
         player.inspect_packet(packet)
 
+        if isinstance(packet, net_classes.NetSysDelivered):
+            player.delivered(packet.sequence_id)
+            return
+
         if isinstance(packet, net_classes.NetSysPing):
             player.send_packet(net_classes.NetSysDelivered(sequence_id=packet.sequence_id))
             return
 
         if packet.packet_flags & net_messages.PKT_FLAG_GARANT:
+            # Repeats are acked again, our first ack may have been lost, but not handled or relayed again
             player.send_packet(net_classes.NetSysDelivered(sequence_id=packet.sequence_id))
+            if player.received.duplicate(packet.sequence_id):
+                return
 
-        if player.should_ping():
-            player.send_ping(game_started=self.game_started,
-                             time_stamp=self.time_stamp)
+        if isinstance(packet, net_classes.UAMessagePong) and packet.packet_to == self.game_id:
+            # The answer to our UAMSG_REQPING, pongs between players are relayed
+            player.link.pong(packet.timestamp, self.clock.millis())
+            return
 
         if isinstance(packet, net_classes.UAMessageReady):
             player.ready = packet.ready
             # noreturn
 
         if isinstance(packet, net_classes.UAMessageMessage):
-            print(f"New message: {packet.message}")
+            log.info("New message: %s", packet.message)
             if packet.message == "!restart":
-                print(f"{player.player_name} has restarted the server")
+                log.info("%s has restarted the server", player.player_name)
                 raise RestartServer()
 
             if player.is_host and packet.message == "!start":
-                print(f"{player.player_name} has started the game")
+                log.info("%s has started the game", player.player_name)
                 self.start_game()
                 return
 
@@ -304,11 +448,30 @@ class UAMPGame:
                 player.send_message(f"Game ID: {self.game_id}")
                 return
 
+            if player.is_host and packet.message == "!pings":
+                # Numbered like !kick expects
+                for i, other in enumerate(self.players.values(), 1):
+                    rtt, jitter = other.link.ping_millis()
+                    ping = "no ping yet" if rtt is None else f"{rtt}+/-{jitter} ms"
+                    player.send_message(f"{i}. {other.player_name}: {ping}, "
+                                        f"{other.link.sent_loss:.0%}/{other.link.received_loss:.0%} lost")
+                return
+
             if player.is_host and packet.message == ("!lock"):
                 self.game_locked = True
+                self.update_open_games()
                 player.send_message(f"Game locked. No new players can join.")
                 return
 
+            if packet.message == "!games":
+                games = list_games()
+                for game_id, level_number, players, max_players in games[:max_listed_games]:
+                    player.send_message(f"{game_id} {net_games.game_names.get(level_number, '???')} "
+                                        f"{players}/{max_players}")
+                if not games:
+                    player.send_message("No games are open.")
+                return
+
             if packet.message.startswith("!connect"):
                 global all_games
                 player_name = player.player_name
@@ -331,16 +494,28 @@ class UAMPGame:
                         self.kick_player(player, reconnecting=True)
 
                         # Add player to specified game
-                        new_player = game.add_player(player_name, player_addr_port, player_id)
+                        new_player = game.add_player(player_name, player_addr_port, player_id, player.state())
+                        return
+
+                # The game may be running in another worker process
+                owner = worker and worker.game_owner(game_id)
+                if owner and owner[0] != worker.index:
+                    if not owner[1]:
+                        player.send_message(message="Game is full or started.")
+                        return
+
+                    self.kick_player(player, reconnecting=True)
+                    worker.move_player(player_addr_port, owner[0], game_id, player_id, player_name, player.state())
                 return
 
             if player.is_host and packet.message.startswith("!unlock"):
                 self.game_locked = False
+                self.update_open_games()
                 player.send_message(f"Game unlocked. Allowing new players.")
                 return
 
             if player.is_host and packet.message.startswith("!kick"):
-                print(f"{player.player_name} wants to kick player index {packet.message[5:]}")
+                log.info("%s wants to kick player index %s", player.player_name, packet.message[5:])
                 try:
                     i = int(packet.message[5:])
                 except ValueError:
@@ -353,7 +528,7 @@ class UAMPGame:
                 return
 
             if player.is_host and packet.message.startswith("!level"):
-                print(f"{player.player_name} wants to change level to {packet.message[6:]}")
+                log.info("%s wants to change level to %s", player.player_name, packet.message[6:])
                 try:
                     level_number = int(packet.message[6:])
                 except ValueError:
@@ -373,7 +548,7 @@ class UAMPGame:
                     if conflicts:
                         self.message_all_players(message=conflicts)
                 except ValueError:
-                    print(f"Couldn't change level to {level_number}")
+                    log.info("Couldn't change level to %s", level_number)
                     player.send_message(f"Couldn't change level to {level_number}")
                 return
 
@@ -383,33 +558,41 @@ class UAMPGame:
                 pass
 
         if isinstance(packet, net_classes.NetSysDisconnected):
-            print(f"{player.player_name} has left")
+            log.info("%s has left", player.player_name)
             self.kick_player(player)
             return
 
         if isinstance(packet, net_classes.Part):
-            if packet.sequence_id not in self.multi_part_packets:
-                self.multi_part_packets[packet.sequence_id] = packet
-            else:
-                self.multi_part_packets[packet.sequence_id].add_part_data(packet.offset, packet.part_data)
-
-            if self.multi_part_packets[packet.sequence_id].is_complete():
-                # Queue packet
-                reconstructed_packet = self.multi_part_packets[packet.sequence_id].reconstructed_packet()
+            reconstructed_packet = self.parts.add(player_addr_port, packet)
+            if reconstructed_packet:
                 try:
                     pkt = net_classes.data_to_class(reconstructed_packet)
                     self.packet_received(pkt, player_addr_port)
                 except Exception as e:
-                    print(f"Multipart packet exception! {e}")
-
-                # Remove from dictionary
-                del self.multi_part_packets[packet.sequence_id]
+                    log.warning("Multipart packet exception! %s", e)
             return
 
         if packet.packet_type == net_messages.USR_MSG_DATA and packet.packet_cast:
             for addr_port, p in self.players.items():
                 if addr_port != player_addr_port:
-                    p.send_packet(packet)
+                    p.relay_data(packet.data)
+
+    def relay_received(self, data, player_addr_port, packet_flags, sequence_id, packet_cast):
+        # Fast path of packet_received() for game data the server never looks into, see switch_datagram()
+        # The received buffer is acked and forwarded as is, no packet object gets built
+        player = self.players[player_addr_port]
+        player.last_packet_time = self.clock.now
+        player.link.received(sequence_id)
+
+        if packet_flags & net_messages.PKT_FLAG_GARANT:
+            player.send_packet(net_classes.NetSysDelivered(sequence_id=sequence_id))
+            if player.received.duplicate(sequence_id):
+                return
+
+        if packet_cast:
+            for addr_port, p in self.players.items():
+                if addr_port != player_addr_port:
+                    p.relay_data(data)
 
     def is_full(self):
         # Can we add in more players to this game?
@@ -422,24 +605,74 @@ class UAMPGame:
         return self.num_players >= self.max_players()
 
 
-def switch_packet(packet, player_addr_port, games, sock):
-    for game in games:  # Can be optimized later
-        if player_addr_port in game:
-            # print("Found game that player is in")
-            game.packet_received(packet, player_addr_port)
-            return  # Packet was sent to the correct game so let's get more packets
+def list_games():
+    # (game_id, level_number, players, max players) of every game that isn't locked or started, on every worker
+    if worker:
+        return [(game_id, level_number, players, max_players)
+                for index, game_id, level_number, players, max_players, locked, started in worker.directory.games()
+                if not locked and not started]
+
+    return [(game.game_id, game.level_number, game.num_players, game.max_players())
+            for game in all_games if not game.game_locked and not game.game_started]
+
+
+def find_open_game():
+    # Fill up the game with the fewest free slots first, the buckets are keyed by free slots (at most 4 of them)
+    for open_slots in sorted(open_games):
+        for game in open_games[open_slots].values():
+            return game
+    return None
+
+
+def switch_datagram(data, player_addr_port, games, sock, loop, clock, routed=False):
+    # Entry point for every datagram the server receives
+    # routed is set for datagrams another worker received for one of our players, see net_workers
+    game = all_players.get(player_addr_port)
+    if not game and worker and not routed and player_addr_port in worker.routes:
+        worker.forward(worker.routes[player_addr_port], player_addr_port, data)
+        return
+
+    if game and len(data) >= relay_header.size:
+        packet_flags, sequence_id, packet_type, packet_cast, ua_message = relay_header.unpack_from(data)
+        if not packet_flags & (net_messages.PKT_FLAG_PART | net_messages.PKT_FLAG_MASK_SYSTEM) and \
+                packet_type == net_messages.USR_MSG_DATA and ua_message in relay_messages:
+            game.relay_received(data, player_addr_port, packet_flags, sequence_id, packet_cast)
+            return
+
+    try:
+        # Convert the raw data to an object
+        packet = net_classes.data_to_class(data)
+        if packet:
+            switch_packet(packet=packet, player_addr_port=player_addr_port, games=games, sock=sock, loop=loop,
+                          clock=clock, routed=routed)
+    except net_classes.DataToClassException:
+        log.warning("Error parsing packet with data: %s", net_log.Hex(data))
+
+
+def switch_packet(packet, player_addr_port, games, sock, loop, clock, routed=False):
+    game = all_players.get(player_addr_port)
+    if game:
+        game.packet_received(packet, player_addr_port)
+        return  # Packet was sent to the correct game so let's get more packets
 
     # Ok so the packet came from a player who wasn't in a game, is it a join request packet?
     if isinstance(packet, net_classes.NetSysHandshake):
-        for game in games:
-            if not game.is_full():
-                # print("Adding player to game")
-                game.add_player(packet.client_name, player_addr_port)
-                game.packet_received(packet, player_addr_port)
-                return
+        game = find_open_game()
+        if game:
+            # print("Adding player to game")
+            game.add_player(packet.client_name, player_addr_port)
+            game.packet_received(packet, player_addr_port)
+            return
+
+        # Fill the open games of the other workers before starting a new game
+        index = worker.find_open_game() if worker and not routed else None
+        if index is not None:
+            worker.routes[player_addr_port] = index
+            worker.forward(index, player_addr_port, packet.data)
+            return
 
-        print("Creating a new game")
-        game = UAMPGame(sock=sock)
+        log.info("Creating a new game")
+        game = UAMPGame(sock=sock, loop=loop, clock=clock, games=games)
         games.append(game)
         game.add_player(packet.client_name, player_addr_port)
         game.packet_received(packet, player_addr_port)
@@ -448,61 +681,401 @@ def switch_packet(packet, player_addr_port, games, sock):
     # Either we got an invalid packet from someone who got dropped from the game or
     # someone is messing with us.
     # Or we restarted the dedicated server while games were running.
-    print(f"Ignoring packet {packet} from {player_addr_port}")
+    log.info("Ignoring packet %s from %s", packet, player_addr_port)
 
 
 all_games = []  # type: list[UAMPGame]
+all_players = {}  # type: dict[tuple, UAMPGame]  # Which game each (addr, port) is playing in
+open_games = {}  # type: dict[int, dict[int, UAMPGame]]  # Games accepting players, by free slots then game_id
+worker = None  # type: net_workers.Worker  # Set when this process is one of several workers sharing the port
+
+# USR_MSG_DATA messages that packet_received() never inspects, switch_datagram() relays them without decoding
+inspected_messages = {net_messages.UAMSG_MESSAGE, net_messages.UAMSG_READY, net_messages.UAMSG_FACTION,
+                      net_messages.UAMSG_PONG}
+relay_messages = frozenset(ua_message for flags_class, message, ua_message in net_classes.decoders
+                           if message == net_messages.USR_MSG_DATA and flags_class == net_messages.PKT_FLAG_NONE and
+                           ua_message not in inspected_messages)
+relay_header = struct.Struct("<BI1xB8xB8x4xI")  # flags, sequence_id, packet_type, packet_cast, ua message
+
+ping_interval = 2  # Seconds between pings sent to each player
+kick_timeout = 10  # Seconds without any packet before a player is kicked
+max_packets_per_wakeup = 1024  # Cap the drain so timers still run under a flood of packets
+max_listed_games = 5  # Games !games sends to the player
+max_datagram_size = 1200  # Bigger packets are sent in parts, below the MTU of any path so IP doesn't fragment
+min_part_size = 64  # Bytes of the packet each part carries at least, bounds --mtu from below
+
+
+def receive_packets(sock, games, sender, buffers, loop, clock):
+    # Read every datagram queued on the socket, the selector only tells us that at least one is waiting
+    # Replies go through sender and are sent in one batch once the burst is handled
+    # Every datagram of the burst gets its own buffer from the pool and is passed on as a memoryview, nothing
+    # may keep a reference to it after the burst: flush sender before the buffers are reused
+    for buffer in buffers:
+        try:
+            # Receive data from players
+            size, player_addr_port = sock.recvfrom_into(buffer)
+        except BlockingIOError:
+            return
+
+        switch_datagram(buffer[:size], player_addr_port, games, sender, loop, clock)
 
 
-def main():
+def receive_routed(games, sender, buffer, loop, clock):
+    # Read the messages other workers sent to this one, see net_workers
+    # Each datagram carries many messages and is read into the same buffer, so it is flushed after every datagram
+    for _ in range(max_packets_per_wakeup):
+        try:
+            size = worker.socket.recv_into(buffer)
+        except BlockingIOError:
+            return
+
+        for kind, index, player_addr_port, payload in worker.parse(buffer[:size]):
+            if kind == net_workers.ROUTE_DATAGRAM:
+                switch_datagram(payload, player_addr_port, games, sender, loop, clock, routed=True)
+                if player_addr_port in all_players:
+                    worker.receivers[player_addr_port] = index
+            elif kind == net_workers.ROUTE_PLAYER:
+                if index == net_workers.no_worker:
+                    worker.routes.pop(player_addr_port, None)
+                else:
+                    worker.routes[player_addr_port] = index
+            elif kind == net_workers.ROUTE_MIGRATE:
+                migrate_routed(payload, player_addr_port, index, games, sender, loop, clock)
+        flush(sender)
+
+
+def flush(sender):
+    # Send everything queued for the players and the other workers
+    sender.flush()
+    if worker:
+        worker.flush()
+
+
+def migrate_routed(payload, player_addr_port, receiver, games, sender, loop, clock):
+    # A player used !connect to move into one of our games from a game of another worker
+    game_id, player_id, player_name, player_state = worker.parse_migration(payload)
+    game = next((game for game in games if game.game_id == game_id), None)
+    if game and not game.is_full():
+        game.add_player(player_name, player_addr_port, player_id, player_state)
+    else:
+        # The game filled up or ended meanwhile, the player already left their old game so find them another one
+        game = find_open_game()
+        if not game:
+            game = UAMPGame(sock=sender, loop=loop, clock=clock, games=games)
+            games.append(game)
+        new_player = game.add_player(player_name, player_addr_port, player_id, player_state)
+        new_player.send_message(message="Game is full or started.")
+
+    worker.player_joined(player_addr_port, receiver)
+
+
+def main(this_worker=None, socket_fd=None, snapshot=None):
     # Server code
-    dedicated_server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # With this_worker, this process is one of several serving the port, see net_workers.supervise()
+    # With socket_fd and snapshot, this process replaces a server that restarted, see hot_restart() and hand_over()
+    global worker
+    worker = this_worker
+
+    if socket_fd is not None:
+        dedicated_server_socket = socket.socket(fileno=socket_fd)
+    else:
+        dedicated_server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if worker:
+            # Every worker binds the port, the kernel spreads the clients over them by address
+            dedicated_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        dedicated_server_socket.bind(("0.0.0.0", 61234))
     dedicated_server_socket.setblocking(False)
-    dedicated_server_socket.bind(("0.0.0.0", 61234))
-
-    # Game restart variables
+    sender = net_send.SendQueue(dedicated_server_socket)
+    receive_buffers = [memoryview(bytearray(1500)) for _ in range(max_packets_per_wakeup)]
+    worker_buffer = memoryview(bytearray(net_workers.max_batch_size))
+
+    # Block until a datagram arrives or the next timer is due instead of polling
+    # Pings, idle kicks and housekeeping are timers, idle games and players cost nothing between them
+    selector = selectors.DefaultSelector()
+    selector.register(dedicated_server_socket, selectors.EVENT_READ)
+    if worker:
+        selector.register(worker.socket, selectors.EVENT_READ)
+    # The clock is read once per wakeup, by everything handling it and by the timers
+    clock = net_timers.Clock()
+    timers = net_timers.TimerQueue(clock)
+    if snapshot:
+        restore_games(snapshot, all_games, sender, timers, clock)
     server_is_restarting = False
-    server_restart_time = 0
-    server_restart_msg_time = 0
-
-    global all_games
+    # A new server process can take the socket over, see hand_over()
+    handoff_listener = None
+    if not worker:
+        handoff_listener = net_handoff.listen(dedicated_server_socket.getsockname()[1])
+    if handoff_listener:
+        selector.register(handoff_listener, selectors.EVENT_READ)
 
     while True:
-        for game in all_games:  # Can be optimized later
-            game.check_game()
-            if game.game_started and game.game_finished:
-                print(f"Purging game {game.game_id} with no players")
-                all_games.remove(game)
-                continue
-            if server_is_restarting:
-                if int(time.time()) > server_restart_time:
-                    game.kick_all_players()
-                    raise Exception("Time to restart the server")
-
-                if int(time.time()) - server_restart_msg_time >= 1:
-                    server_restart_msg_time = int(time.time())
-                    game.message_all_players(message="Server is restarting in "
-                                                     f"{server_restart_time - int(time.time())} seconds")
+        events = selector.select(timeout=timers.timeout())
+        clock.tick()
+
+        if handoff_listener and any(key.fileobj is handoff_listener for key, mask in events):
+            if hand_over(handoff_listener, all_games, dedicated_server_socket, sender, handoff_listener.close):
+                return
 
         try:
-            time.sleep(0.001)  # sleep 1 ms
-            # Receive data from players
-            data, player_addr_port = dedicated_server_socket.recvfrom(1500)
-            # Convert the raw data to an object
-            packet = net_classes.data_to_class(data)
-            if packet:
-                switch_packet(packet=packet, player_addr_port=player_addr_port,
-                              games=all_games, sock=dedicated_server_socket)
-        except BlockingIOError:
-            pass
+            receive_packets(dedicated_server_socket, all_games, sender, receive_buffers, timers, clock)
+            flush(sender)
+            if worker:
+                receive_routed(all_games, sender, worker_buffer, timers, clock)
+        except RestartServer:
+            if not worker:
+                hot_restart(all_games, dedicated_server_socket, sender)  # Only returns when it couldn't restart
+            # A worker can't replace itself, the supervisor would take it for dead and stop every worker
+            elif not server_is_restarting:
+                server_is_restarting = True
+                restart_countdown(all_games, timers, sender, 5)
+
+        timers.run()
+        flush(sender)
+
+
+def restart_countdown(games, timers, sender, seconds_left):
+    if seconds_left < 0:
+        for game in games:
+            game.kick_all_players()
+        flush(sender)
+        raise Exception("Time to restart the server")
+
+    for game in games:
+        game.message_all_players(message=f"Server is restarting in {seconds_left} seconds")
+    timers.call_later(1, restart_countdown, games, timers, sender, seconds_left - 1)
+
+
+def hot_restart(games, sock, sender):
+    # Replace this process with a new start of the server that carries on with the games on the same socket,
+    # so deploying a fix doesn't end every match. Datagrams arriving meanwhile wait in the socket's buffer
+    # Returns when the games couldn't be saved, the server then carries on without restarting
+    for game in games:
+        game.message_all_players(message="Server is restarting, your game goes on.")
+    flush_players(games, sender)
+
+    path = net_snapshot.snapshot_path()
+    try:
+        net_snapshot.save(path, [game.snapshot() for game in games if not game.game_finished])
+    except (OSError, struct.error):
+        log.exception("Couldn't save the games, not restarting")
+        for game in games:
+            game.message_all_players(message="Server restart failed, your game goes on.")
+        return
+    log.info("Restarting the server with %s games", len(games))
+    net_log.stop_logging()
+
+    socket_fd = sock.fileno()
+    os.set_inheritable(socket_fd, True)
+    arguments = restart_arguments() + ["--restore", path, "--socket-fd", str(socket_fd)]
+    os.execv(sys.executable, [sys.executable] + arguments)
+
+
+def hand_over(listener, games, sock, sender, stop_listening):
+    # A new server process connected to listener to take over, give it the socket and the games
+    # Returns whether it took over, this process is done serving then and only has to exit
+    # stop_listening() closes listener once the new process took over, see net_handoff.hand_over()
+    # The acknowledgements of our unacknowledged guaranteed packets arrive at the new process, so it carries on
+    # retransmitting them instead of this process waiting for them
+    connection = net_handoff.accept(listener)
+    if connection is None:
+        return False
+
+    with connection:
+        flush_players(games, sender)
+        games = [game for game in games if not game.game_finished]
+        try:
+            snapshot = net_snapshot.pack([game.snapshot() for game in games])
+        except struct.error:
+            # Hanging up makes the new process give up, we carry on serving
+            log.exception("Couldn't pack the games, not handing the server over")
+            return False
+        if not net_handoff.hand_over(connection, sock, snapshot):  # Carries on serving when sending failed too
+            return False
+
+        log.info("Handed the server over with %s games", len(games))
+        for game in games:
+            for player in game.players.values():
+                game.stop_player_timers(player)
+        stop_listening()
+    return True
+
+
+def flush_players(games, sender):
+    # Send everything still waiting for a player, before another process takes over
+    for game in games:
+        for player in game.players.values():
+            player.pacer.flush()
+    flush(sender)
+
+
+def restart_arguments():
+    # The command line of this process, without the options a previous hot_restart() or handoff added
+    arguments = []
+    skip = False
+    for argument in sys.argv:
+        if skip:
+            skip = False
+        elif argument == "--take-over":
+            continue
+        elif argument in ("--restore", "--socket-fd"):
+            skip = True
+        else:
+            arguments.append(argument)
+    return arguments
+
+
+def restore_games(snapshot, games, sock, loop, clock):
+    # Recreate the games of net_snapshot.load(), the players don't notice anything
+    for game_id, level_number, locked, started, elapsed, players in snapshot:
+        game = UAMPGame(sock=sock, loop=loop, clock=clock, games=games)
+        game.game_id = game_id
+        game.level_number = level_number
+        game.game_locked = locked
+        game.game_started = started
+        game.game_start_time = clock.now - elapsed
+        for player_id, player_addr_port, player_name, player_state, is_host, unacked in players:
+            player = game.join(player_name, player_addr_port, player_id, player_state)
+            player.is_host = is_host
+            player.reliable.resume(unacked)
+        games.append(game)
+    log.info("Restored %s games", len(snapshot))
+
+
+class UAMPServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, games, restart_in_place=False, snapshot=None):
+        self.games = games
+        self.restart_in_place = restart_in_place  # !restart replaces the process, see hot_restart()
+        self.snapshot = snapshot  # Games to restore before the first datagram is handled
+        self.transport = None
+        self.sender = None  # Batches everything sent during one loop iteration, see net_send.SendQueue
+        self.loop = asyncio.get_running_loop()
+        self.clock = net_timers.Clock()  # Ticked for every datagram, asyncio hands them over one at a time
+        self.timers = net_timers.AsyncioTimers(self.loop, self.clock)  # Runs the games' timers, ticking the clock
+        self.finished = self.loop.create_future()  # Resolves (with an exception) once the server shuts down
+        self.server_is_restarting = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.sender = net_send.SendQueue(transport, loop=self.loop)
+        if self.snapshot:
+            restore_games(self.snapshot, self.games, self.sender, self.timers, self.clock)
+            self.snapshot = None
+
+    def connection_lost(self, exc):
+        if not self.finished.done():
+            self.finished.set_result(None)
+
+    def datagram_received(self, data, player_addr_port):
+        self.clock.tick()
+        try:
+            switch_datagram(data, player_addr_port, self.games, self.sender, self.timers, self.clock)
         except RestartServer:
-            server_is_restarting = True
-            server_restart_time = int(time.time()) + 5
-            pass
-        except net_classes.DataToClassException:
-            print(f"Error parsing packet with data:\n{binascii.hexlify(data)}")
-            pass
+            if self.restart_in_place:
+                hot_restart(self.games, self.transport.get_extra_info("socket"), self.sender)
+            elif not self.server_is_restarting:
+                self.server_is_restarting = True
+                self.restart_countdown(5)
+
+    def hand_over(self, listener, stop_listening):
+        # Runs when a new server process connects to listener, see hand_over()
+        self.clock.tick()
+        if hand_over(listener, self.games, self.transport.get_extra_info("socket"), self.sender, stop_listening):
+            self.transport.close()  # Stops reading right away, the socket is the new process's now
+
+    def restart_countdown(self, seconds_left):
+        if seconds_left < 0:
+            for game in self.games:
+                game.kick_all_players()
+            self.finished.set_exception(Exception("Time to restart the server"))
+            self.sender.flush()
+            self.transport.close()
+            return
+
+        for game in self.games:
+            game.message_all_players(message=f"Server is restarting in {seconds_left} seconds")
+        self.timers.call_later(1, self.restart_countdown, seconds_left - 1)
+
+
+async def serve(host="0.0.0.0", port=61234, games=None, sock=None, restart_in_place=False, snapshot=None):
+    # Start the dedicated server on the running event loop, so it can share a process with other asyncio code
+    # Returns the transport and protocol, await protocol.finished to wait for the server to shut down
+    # With sock the server uses that bound socket instead of binding host and port
+    # With restart_in_place, !restart replaces the whole process, so only set it when the process is ours
+    # snapshot holds the games of a server that restarted, see hot_restart()
+    if games is None:
+        games = all_games
+
+    loop = asyncio.get_running_loop()
+    if sock:
+        return await loop.create_datagram_endpoint(lambda: UAMPServerProtocol(games, restart_in_place, snapshot),
+                                                   sock=sock)
+    return await loop.create_datagram_endpoint(lambda: UAMPServerProtocol(games, restart_in_place, snapshot),
+                                               local_addr=(host, port))
+
+
+async def main_asyncio(socket_fd=None, snapshot=None):
+    sock = socket.socket(fileno=socket_fd) if socket_fd is not None else None
+    transport, protocol = await serve(sock=sock, restart_in_place=True, snapshot=snapshot)
+    loop = asyncio.get_running_loop()
+    handoff_listener = net_handoff.listen(transport.get_extra_info("sockname")[1])
+
+    def stop_listening():
+        # The reader has to go before the socket, asyncio can't look a closed socket up anymore
+        loop.remove_reader(handoff_listener)
+        handoff_listener.close()
+
+    if handoff_listener:
+        loop.add_reader(handoff_listener, protocol.hand_over, handoff_listener, stop_listening)
+    try:
+        await protocol.finished
+    finally:
+        if handoff_listener and handoff_listener.fileno() != -1:  # Not closed by a handoff yet
+            stop_listening()
+        transport.close()
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Urban Assault dedicated server")
+    parser.add_argument("--asyncio", action="store_true", help="run the server on an asyncio event loop")
+    parser.add_argument("--log-level", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="DEBUG also logs the type of every received message")
+    parser.add_argument("--log-rate", type=int, default=10,
+                        help="max log records per second for each message type, 0 for no limit")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve with this many worker processes sharing the port (Linux only)")
+    parser.add_argument("--mtu", type=int, default=max_datagram_size,
+                        help="largest datagram sent to players, bigger packets are sent in parts")
+    # Passed by !restart to the process replacing the server, see hot_restart()
+    parser.add_argument("--restore", help="snapshot of the games to carry on with")
+    parser.add_argument("--socket-fd", type=int, help="inherited server socket to serve from")
+    parser.add_argument("--take-over", action="store_true",
+                        help="take the socket and games over from the server running on the port, then it exits")
+    args = parser.parse_args()
+    if not net_classes.Part.header.size + min_part_size <= args.mtu <= 65507:
+        parser.error(f"--mtu must be between {net_classes.Part.header.size + min_part_size} and 65507")
+    max_datagram_size = args.mtu
+    if args.take_over and args.workers > 1:
+        parser.error("--take-over can't be used with --workers")
+
+    if args.workers > 1:
+        def run_worker(this_worker):
+            net_log.setup_logging(level=args.log_level, rate=args.log_rate, process_name=True)
+            main(this_worker)
+
+        sys.exit(net_workers.supervise(args.workers, run_worker))
+
+    net_log.setup_logging(level=args.log_level, rate=args.log_rate)
+    snapshot = net_snapshot.load(args.restore) if args.restore else None
+    if args.take_over:
+        try:
+            args.socket_fd, handoff_snapshot = net_handoff.take_over(61234)
+        except OSError as e:
+            sys.exit(f"Couldn't take over the running server: {e}")
+        snapshot = net_snapshot.unpack(handoff_snapshot)
+        if snapshot is None:
+            log.warning("The running server packs its games differently, they are lost")
+
+    if args.asyncio:
+        asyncio.run(main_asyncio(args.socket_fd, snapshot))
+    else:
+        main(socket_fd=args.socket_fd, snapshot=snapshot)
@@ -0,0 +1,76 @@
+import gc
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import net_classes
+import net_messages
+import net_timers
+import uads
+
+# Bytes allocated per decoded packet and per connected client
+# Run it before and after a change to the packet or client classes to compare
+count = 10000
+
+
+def measure(make):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [make(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    # The list holding the objects is 8 bytes per entry
+    return (after - before) / count - 8
+
+
+def vehicle_data(i):
+    packet = bytearray(net_classes.UAMessageRequestPing(to_id=1, from_id=2, sequence_id=i).data)
+    packet[28:32] = net_messages.UAMSG_VHCLDATA_I.to_bytes(4, "little")
+    return bytes(packet)
+
+
+class FakeSocket:
+    def sendto(self, data, addr):
+        pass
+
+
+def main():
+    welcome = [net_classes.UAMessageWelcome(to_id=1, from_id=2, sequence_id=i).data for i in range(count)]
+    vehicle = [vehicle_data(i) for i in range(count)]
+    sock = FakeSocket()
+    clock = net_timers.Clock()
+    timers = net_timers.TimerQueue(clock)
+
+    def decode_and_read(data):
+        packet = net_classes.data_to_class(data)
+        packet.sequence_id  # Force the payload to be decoded
+        return packet
+
+    results = (
+        ("UAMessageWelcome, received", lambda i: net_classes.data_to_class(welcome[i])),
+        ("UAMessageWelcome, received and read", lambda i: decode_and_read(welcome[i])),
+        ("UAMSG_VHCLDATA_I (Generic), received", lambda i: net_classes.data_to_class(vehicle[i])),
+        ("UAMessageWelcome, built to send", lambda i: net_classes.UAMessageWelcome(to_id=1, from_id=2)),
+        ("UAMPClient", lambda i: uads.UAMPClient(sock=sock, loop=timers, clock=clock, game_id=1,
+                                                 player_name=f"p{i}", remote_addr="127.0.0.1", remote_port=i)),
+    )
+
+    # The received buffers are shared with the packets and not counted, only the packet objects are
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")  # Unknown messages are logged to stdout
+    try:
+        measured = [(name, measure(make)) for name, make in results]
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    for name, size in measured:
+        print(f"{name:40} {size:8.1f} bytes")
+
+
+if __name__ == "__main__":
+    main()